@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Measure the peak memory of the Shotgun shot fetch of the plugin
+
+Runs ShotgunPlugin._retrieve_shotgun_shots against a Shotgun stand-in which
+decodes each page of shots from JSON, like shotgun_api3 does, so that the
+strings of the shots are not shared by accident. The stand-in builds its pages
+on the fly and does not hold the shots itself. Each mode runs in its own
+process and is measured by its peak memory, above the "none" mode which
+decodes every page without keeping anything:
+
+    dicts       the shots returned by a single unpaged find, kept as dicts
+    unpaged     a single unpaged find compacted into shot records, the fetch
+                before the default path was paged
+    paged       _retrieve_shotgun_shots, the default path
+    streaming   _retrieve_shotgun_shots with streamingFetch
+
+    python2.7 benchmarks/bench_memory.py --shots 300000
+
+Options:
+    --shots         Number of shots (default 300000)
+    --sequences     Sequences per show (default 50)
+    --shots-per-sequence
+                    Shots per sequence (default 100), the number of shows follows
+    --versions      Shotgun versions per shot (default 5)
+    --page-size     Shots per page, shotgunPageSize (default 500)
+"""
+
+from __future__ import print_function # Use Python 3 printing
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HOSTSTORAGE_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'hoststorage')
+STATUSES = ['wtg', 'rdy', 'ip', 'rev', 'fin']
+MODES = ['none', 'dicts', 'unpaged', 'paged', 'streaming']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Measure the peak memory of the Shotgun shot fetch of the plugin')
+    parser.add_argument('--shots', type=int, default=300000)
+    parser.add_argument('--sequences', type=int, default=50)
+    parser.add_argument('--shots-per-sequence', type=int, default=100)
+    parser.add_argument('--versions', type=int, default=5)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--run-one', choices=MODES, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def shot_page(args, start, stop):
+    # JSON page of the shots start to stop, as returned by the Shotgun API
+    shots_per_show = args.sequences * args.shots_per_sequence
+    updated_at = datetime.datetime(2020, 1, 1).isoformat()
+    page = []
+    for i in range(start, stop):
+        show, rest = divmod(i, shots_per_show)
+        sequence, shot = divmod(rest, args.shots_per_sequence)
+        project_name = 'show%03d' % show
+        sequence_name = 'sq%03d' % sequence
+        code = 'sh%04d' % shot
+        page.append({
+            'type': 'Shot', 'id': i + 1, 'code': code,
+            'project': {'type': 'Project', 'id': show + 1, 'name': project_name},
+            'sg_sequence': {'type': 'Sequence', 'id': show * args.sequences + sequence + 1, 'name': sequence_name},
+            'sg_versions': [{'type': 'Version', 'id': i * args.versions + v + 1,
+                             'name': '%s_%s_%s_v%03d' % (project_name, sequence_name, code, v + 1)}
+                            for v in range(args.versions)],
+            'sg_status_list': STATUSES[i % len(STATUSES)],
+            'updated_at': updated_at})
+    return json.dumps(page)
+
+
+def decode_shot(shot):
+    # shotgun_api3 returns the date fields as datetimes
+    if 'updated_at' in shot:
+        shot['updated_at'] = datetime.datetime.strptime(shot['updated_at'], '%Y-%m-%dT%H:%M:%S')
+    return shot
+
+
+def decode_page(args, start, stop):
+    return json.loads(shot_page(args, start, stop), object_hook=decode_shot)
+
+
+def make_shotgun(args):
+    class JsonShotgun(object):
+        # Shotgun stand-in serving the shots as pages decoded from JSON
+        def __init__(self, base_url, script_name=None, api_key=None, **kwargs):
+            pass
+
+        def find(self, entity_type, filters, fields=None, order=None, limit=0, page=0, **kwargs):
+            if limit:
+                start = min(args.shots, (max(page, 1) - 1) * limit)
+                return decode_page(args, start, min(args.shots, start + limit))
+            shots = []
+            for start in range(0, args.shots, args.page_size):
+                shots.extend(decode_page(args, start, min(args.shots, start + args.page_size)))
+            return shots
+
+        def close(self):
+            pass
+    return JsonShotgun
+
+
+def run_one(args):
+    # Fetch the shots in the given mode and keep them
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, HOSTSTORAGE_DIR)
+    import fakes
+    fakes.install(fakes.SyntheticSite(projects=0))
+    sys.modules['shotgun_api3'].Shotgun = make_shotgun(args)
+    import logging
+    logging.disable(logging.WARNING)
+    import cn_shotgun
+    config = {'shotgunAPIUrl': 'shotgun.invalid', 'shotgunAPIScriptName': 'benchmark', 'shotgunAPIKey': 'benchmark',
+              'shotgunQueryFilter': 'none', 'shotgunPageSize': args.page_size,
+              'streamingFetch': str(args.run_one == 'streaming'), 'shotgunConcurrency': 1}
+
+    class BenchmarkPlugin(cn_shotgun.ShotgunPlugin):
+        def _get_dataiq_cfg(self):
+            return dict(config)
+
+    plugin = BenchmarkPlugin(BENCHMARKS_DIR)
+    base_rss = max_rss_mb()
+    if args.run_one == 'none':
+        shots = []
+        for start in range(0, args.shots, args.page_size):
+            decode_page(args, start, min(args.shots, start + args.page_size))
+    elif args.run_one == 'dicts':
+        shots = plugin.sg.find('Shot', [], plugin.SHOT_FIELDS)
+    elif args.run_one == 'unpaged':
+        shots = list(plugin._compact_shots(plugin.sg.find('Shot', [], plugin.SHOT_FIELDS)))
+    else:
+        shots = list(plugin._retrieve_shotgun_shots([]))
+    print(json.dumps({'mode': args.run_one, 'base_rss_mb': base_rss, 'peak_rss_mb': max_rss_mb(), 'shots': len(shots)}))
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.run_one is not None:
+        run_one(args)
+        return
+    results = {}
+    for mode in MODES:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-one', mode] + sys.argv[1:])
+        results[mode] = json.loads(output.decode('utf8').strip().splitlines()[-1])
+    # The "none" run decodes the pages without keeping anything, it is the baseline
+    baseline = results['none']['peak_rss_mb']
+    print('== %d shots, %d versions per shot, pages of %d shots ==' % (args.shots, args.versions, args.page_size))
+    for mode in MODES[1:]:
+        print('  %-10s %8.1f MB   %d shots kept' % (mode, results[mode]['peak_rss_mb'] - baseline, results[mode]['shots']))
+    held = results['dicts']['peak_rss_mb'] - baseline
+    if held > 0:
+        for mode in MODES[2:]:
+            print('  %-10s reduction: %.0f%%' % (mode, 100.0 * (1 - (results[mode]['peak_rss_mb'] - baseline) / held)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Compare the ccmtools.ServerMap path translations with the linear scan they replace
+
+Builds a server map over synthetic volumes, nested mounts and many-to-one mounts
+included, and translates virtual paths to physical paths and back with the
+previous linear scan over the volumes, the trie of path components, and the
+trie with an LRU cache, large enough for the distinct paths and much smaller.
+The paths are drawn from a smaller set of distinct paths, as when the same
+selections are translated again. Every translation is checked against the
+linear scan. ccmtools is Python 2.7 code, so is this benchmark:
+
+    python2.7 benchmarks/bench_path_map.py --volumes 300 --paths 200000
+
+Options:
+    --volumes       Number of volumes (default 300)
+    --paths         Number of paths translated each way (default 200000)
+    --distinct      Number of distinct paths the paths are drawn from (default 5000)
+    --cache-size    Size of the LRU cache (default 10000)
+"""
+
+from __future__ import print_function # Use Python 3 printing
+import argparse
+import os
+import random
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HOSTSTORAGE_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'hoststorage')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Compare the ServerMap path translations with the linear scan they replace')
+    parser.add_argument('--volumes', type=int, default=300)
+    parser.add_argument('--paths', type=int, default=200000)
+    parser.add_argument('--distinct', type=int, default=5000)
+    parser.add_argument('--cache-size', type=int, default=10000)
+    return parser.parse_args(argv)
+
+
+class Volume(object):
+    def __init__(self, name, mount):
+        self.name = name
+        self.mount = mount
+
+
+class VolumeApi(object):
+    def __init__(self, volumes):
+        self.volumes = volumes
+
+    def getVolumes(self):
+        return self.volumes
+
+
+def make_volumes(count):
+    # Volumes on a few arrays, every tenth one mounted inside the previous one, every
+    # twentieth one sharing the mount of the previous one, and the root volume
+    volumes = [Volume(u'root', u'/')]
+    for i in range(count):
+        if i % 20 == 19:
+            volumes.append(Volume(u'alias%03d' % i, volumes[-1].mount.rstrip(u'/') + u'/'))
+        elif i % 10 == 9:
+            volumes.append(Volume(u'nested%03d' % i, volumes[-1].mount.rstrip(u'/') + u'/nested'))
+        else:
+            volumes.append(Volume(u'vol%03d' % i, u'/mnt/array%d/vol%03d' % (i % 8, i)))
+    return volumes
+
+
+def make_paths(volumes, args):
+    rng = random.Random(42)
+    distinct = []
+    for i in range(args.distinct):
+        volume = volumes[rng.randrange(len(volumes))]
+        distinct.append(u'/%s/show%02d/sequences/sq%03d/shots/sh%04d/v%03d.exr' % (volume.name, i % 40, i % 300, i, i % 7))
+    # Paths outside the volumes and a volume path without its trailing slash
+    distinct[::1000] = [u'/unknown/path%d' % i for i in range(len(distinct[::1000]))]
+    distinct[1::1000] = [u'/vol000'] * len(distinct[1::1000])
+    return [distinct[rng.randrange(len(distinct))] for i in range(args.paths)]
+
+
+def linear(pairs, path):
+    # ServerMap lookup before the trie: first of the prefixes sorted by decreasing length
+    for prefix, replacement in pairs:
+        if path.startswith(prefix):
+            return replacement + path[len(prefix):]
+    return None
+
+
+def translate_all(translate, paths):
+    results = []
+    for path in paths:
+        try:
+            results.append(translate(path))
+        except LookupError:
+            results.append(None)
+    return results
+
+
+def measure(label, translate, paths, expected):
+    started = time.time()
+    results = translate_all(translate, paths)
+    elapsed = time.time() - started
+    mismatches = sum(1 for result, reference in zip(results, expected) if result != reference)
+    print('  %-30s %7.3f s %10.0f paths/s   %d mismatches' % (label, elapsed, len(paths) / elapsed, mismatches))
+    return results
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    sys.path.insert(0, HOSTSTORAGE_DIR)
+    import ccmtools
+    volumes = make_volumes(args.volumes)
+    api = VolumeApi(volumes)
+    server_map = ccmtools.ServerMap(api)
+    cached_map = ccmtools.ServerMap(api, cacheSize=args.cache_size)
+    small_cache_size = max(1, args.distinct // 10)
+    small_cached_map = ccmtools.ServerMap(api, cacheSize=small_cache_size)
+    virtual = make_paths(volumes, args)
+    print('== %d volumes, %d paths from %d distinct paths ==' % (len(volumes), len(virtual), args.distinct))
+
+    print(' virtual to physical')
+    started = time.time()
+    physical = [linear(server_map.serverMapNM, path) for path in virtual]
+    print('  %-30s %7.3f s %10.0f paths/s' % ('linear scan', time.time() - started, len(virtual) / (time.time() - started)))
+    measure('trie', server_map.getPfilepath, virtual, physical)
+    measure('trie + LRU %d' % args.cache_size, cached_map.getPfilepath, virtual, physical)
+    measure('trie + LRU %d' % small_cache_size, small_cached_map.getPfilepath, virtual, physical)
+
+    # Many-to-one mounts translate back to the first volume of the mount
+    physical = [path for path in physical if path is not None]
+
+    print(' physical to virtual')
+    started = time.time()
+    back = [linear(server_map.serverMapMN, path) for path in physical]
+    print('  %-30s %7.3f s %10.0f paths/s' % ('linear scan', time.time() - started, len(physical) / (time.time() - started)))
+    measure('trie', server_map.getVfilepath, physical, back)
+    measure('trie + LRU %d' % args.cache_size, cached_map.getVfilepath, physical, back)
+    measure('trie + LRU %d' % small_cache_size, small_cached_map.getVfilepath, physical, back)
+    # str paths are decoded before the trie lookup, the LRU cache is keyed by the path as given
+    physical_str = [path.encode('utf8') for path in physical]
+    str_cached_map = ccmtools.ServerMap(api, cacheSize=args.cache_size)
+    measure('trie, str paths', server_map.getVfilepath, physical_str, back)
+    measure('trie + LRU %d, str paths' % args.cache_size, str_cached_map.getVfilepath, physical_str, back)
+
+
+if __name__ == '__main__':
+    main()
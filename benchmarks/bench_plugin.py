@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Benchmark ShotgunPlugin.start against in-process ClarityNow and Shotgun stand-ins
+
+Runs the plugin over synthetic sites of increasing size and reports, for each
+size, the wall time of the run, the number of calls per ClarityNow and Shotgun
+method and the peak memory of the process. Each size runs in its own process
+so that peak memory is measured independently. The plugin is designed for
+Python 2.7, so is this benchmark:
+
+    python2.7 benchmarks/bench_plugin.py --sizes 1000,10000,100000
+    python2.7 benchmarks/bench_plugin.py --latency-ms 2 --config shotPathCache=True
+
+Options:
+    --sizes                 Comma separated numbers of shots (default 1000,10000,100000)
+    --sequences             Sequences per show (default 10)
+    --shots-per-sequence    Shots per sequence (default 25), the number of shows follows
+    --versions              Shotgun versions per shot (default 3)
+    --latency-ms            Milliseconds spent in each fake client call (default 0)
+    --runs                  Consecutive runs over the same site (default 1), the later
+                            runs show the steady state, except with shardProcesses as
+                            the shard worker processes update their own copy of the site
+    --config key=value      Global Configurations entry passed to the plugin, repeatable
+"""
+
+from __future__ import print_function # Use Python 3 printing
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HOSTSTORAGE_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'hoststorage')
+
+DEFAULT_CONFIG = {
+    'shotgunAPIUrl': 'shotgun.invalid',
+    'shotgunAPIScriptName': 'benchmark',
+    'shotgunAPIKey': 'benchmark',
+    'expirationDelay': 7,
+}
+# Prefixes of the stand-in call names, by run metrics backend
+CALL_PREFIXES = {'claritynow': 'cn', 'shotgun': 'sg'}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark ShotgunPlugin.start against in-process stand-ins')
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--sequences', type=int, default=10)
+    parser.add_argument('--shots-per-sequence', type=int, default=25)
+    parser.add_argument('--versions', type=int, default=3)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--config', action='append', default=[])
+    parser.add_argument('--run-one', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def parse_config(entries):
+    config = dict(DEFAULT_CONFIG)
+    for entry in entries:
+        key, value = entry.split('=', 1)
+        config[key] = value
+    return config
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_one(args):
+    # Build the site, run the plugin and print the measures as JSON
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.path.insert(0, HOSTSTORAGE_DIR)
+    import fakes
+    shots_per_show = args.sequences * args.shots_per_sequence
+    site = fakes.SyntheticSite(projects=max(1, args.run_one // shots_per_show), sequences=args.sequences,
+                               shots=args.shots_per_sequence, versions=args.versions)
+    fakes.install(site)
+    fakes.LATENCY[0] = args.latency_ms / 1000.0
+    setup_rss = max_rss_mb()
+
+    import logging
+    logging.disable(logging.WARNING)
+    import cn_shotgun
+    import run_metrics
+    config = parse_config(args.config)
+
+    class BenchmarkPlugin(cn_shotgun.ShotgunPlugin):
+        def _get_dataiq_cfg(self):
+            return dict(config)
+
+    working_dir = tempfile.mkdtemp(prefix='cn_shotgun_bench')
+    os.environ['PLUGIN_WORKING_DIR'] = working_dir
+    runs = []
+    try:
+        for i in range(args.runs):
+            fakes.CALLS.clear()
+            started = time.time()
+            BenchmarkPlugin(working_dir).start()
+            wall_time = time.time() - started
+            calls = dict(fakes.CALLS)
+            summary = run_metrics.load_summary(working_dir)
+            if summary['counts'].get('shards'):
+                # Calls made by the shard worker processes only show in the run summary
+                calls = dict(('%s.%s' % (CALL_PREFIXES[call['backend']], call['method']), call['count']) for call in summary['calls'])
+            runs.append({'wall_time': wall_time, 'calls': calls})
+    finally:
+        shutil.rmtree(working_dir)
+    print(json.dumps({'shots': len(site.shots), 'setup_rss_mb': setup_rss, 'peak_rss_mb': max_rss_mb(), 'runs': runs}))
+
+
+def report(result):
+    print('== %d shots ==' % result['shots'])
+    print('  peak memory: %.1f MB (%.1f MB after building the synthetic site)' % (result['peak_rss_mb'], result['setup_rss_mb']))
+    for i, run in enumerate(result['runs']):
+        calls = run['calls']
+        print('  run %d: %.2f s, %d calls' % (i + 1, run['wall_time'], sum(calls.values())))
+        for method in sorted(calls):
+            print('    %-28s %8d' % (method, calls[method]))
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.run_one is not None:
+        run_one(args)
+        return
+    passthrough = [arg for arg in sys.argv[1:]]
+    for size in [int(size) for size in args.sizes.split(',')]:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-one', str(size)] + passthrough)
+        report(json.loads(output.decode('utf8').strip().splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Measure the shot tag names parsed per second by the shot tag naming rules
+
+Parses synthetic shot tag names with the default "$1_$2_$3" template, a template
+with other delimiters and a regular expression. Most names split in a single way,
+some hold the delimiter in their parts and a few do not follow the rule. Each rule
+parses the names twice: the first pass parses every name, the second one is served
+by the cache of parsed names, as in the later runs of a resident worker or daemon:
+
+    python2.7 benchmarks/bench_shot_names.py --names 500000
+
+Options:
+    --names     Number of shot tag names (default 500000)
+    --repeat    Passes over the names per measure, the best one is kept (default 3)
+"""
+
+from __future__ import print_function # Use Python 3 printing
+import argparse
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HOSTSTORAGE_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'hoststorage')
+
+# Rule name, template, pattern and the delimiter the names are built with
+RULES = [
+    ('template $1_$2_$3', '$1_$2_$3', None, '_'),
+    ('template $1--$2--$3', '$1--$2--$3', None, '--'),
+    ('pattern', '$1_$2_$3', r'(?P<project>[^_]+)_(?P<sequence>[^_]+)_(?P<shot>.+)', '_'),
+]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Measure the shot tag names parsed per second by the shot tag naming rules')
+    parser.add_argument('--names', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args(argv)
+
+
+def make_names(count, delimiter):
+    # 1 name in 20 has a shot code holding the delimiter, 1 in 50 does not follow the rule
+    names = []
+    for i in range(count):
+        if i % 50 == 0:
+            names.append(u'misc%d' % i)
+        elif i % 20 == 0:
+            names.append(delimiter.join([u'show%03d' % (i % 100), u'sq%03d' % (i % 1000), u'sh%06d' % i, u'alt']))
+        else:
+            names.append(delimiter.join([u'show%03d' % (i % 100), u'sq%03d' % (i % 1000), u'sh%06d' % i]))
+    return names
+
+
+def measure(rule, names, clear_cache):
+    started = time.time()
+    if clear_cache:
+        rule.cache.clear()
+    parse = rule.parse
+    for name in names:
+        parse(name)
+    return time.time() - started
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    sys.path.insert(0, HOSTSTORAGE_DIR)
+    from shot_names import ShotNameRule
+    print('== %d shot tag names ==' % args.names)
+    for label, template, pattern, delimiter in RULES:
+        names = make_names(args.names, delimiter)
+        rule = ShotNameRule(template, pattern)
+        parsed = min(measure(rule, names, True) for i in range(args.repeat))
+        cached = min(measure(rule, names, False) for i in range(args.repeat))
+        unparsable = sum(1 for name in names if not rule.parse(name))
+        print('  %-22s parse %9.0f names/s   cached %9.0f names/s   %d not following the rule'
+              % (label, args.names / parsed, args.names / cached, unparsable))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+In-process stand-ins for claritynowapi and shotgun_api3
+
+install() registers fake claritynowapi and shotgun_api3 modules backed by a
+SyntheticSite, so that cn_shotgun can run without a ClarityNow server or a
+Shotgun site. Every call made to the fake clients is counted per method in
+CALLS, and LATENCY seconds are spent in each of them to emulate the network.
+
+The synthetic site follows the layout expected by the autotag rule:
+/volume/<show>/sequences/<sequence>/shots/<shot>/<version>
+"""
+
+from __future__ import print_function # Use Python 3 printing
+import collections
+import datetime
+import sys
+import threading
+import time
+import types
+
+VOLUME = u'volume'
+# Number of calls per method, prefixed by the backend: "cn." or "sg."
+CALLS = collections.Counter()
+# Seconds spent in each call to a fake client
+LATENCY = [0.0]
+_calls_lock = threading.Lock()
+
+
+def _count(name):
+    with _calls_lock:
+        CALLS[name] += 1
+    if LATENCY[0]:
+        time.sleep(LATENCY[0])
+
+
+class Record(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SyntheticSite:
+    """
+    Shows, sequences, shots, versions and folders shared by the fake clients
+
+    Each shot has versions Shotgun versions. All of them but the last one have a
+    folder in the shot folder, which also holds extra_folders folders matching no
+    version. Every fifth shot is finalized.
+    """
+
+    def __init__(self, projects=1, sequences=10, shots=10, versions=3, extra_folders=1):
+        self.lock = threading.RLock()
+        self.next_id = 1
+        self.categories = {}
+        self.tags = {}
+        self.tags_by_id = {}
+        self.children = collections.defaultdict(list)
+        self.mtimes = collections.defaultdict(int)
+        self.folder_tags = collections.defaultdict(set)
+        self.tag_paths = collections.defaultdict(set)
+        self.implied_tags = collections.defaultdict(list)
+        self.shots = []
+        self.events = []
+        self.add_folder(u'/' + VOLUME)
+        shot_id = version_id = 1
+        updated_at = datetime.datetime(2020, 1, 1)
+        for p in range(projects):
+            project = {'type': 'Project', 'id': p + 1, 'name': u'show%03d' % p}
+            for q in range(sequences):
+                sequence = {'type': 'Sequence', 'id': p * sequences + q + 1, 'name': u'sq%03d' % q}
+                for s in range(shots):
+                    code = u'sh%04d' % s
+                    shot_path = u'/%s/%s/sequences/%s/shots/%s' % (VOLUME, project['name'], sequence['name'], code)
+                    self.add_folder(shot_path)
+                    self.add_tag_to_folder(shot_path, u'shot', u'%s_%s_%s' % (project['name'], sequence['name'], code))
+                    sg_versions = []
+                    for v in range(versions):
+                        name = u'%s_%s_%s_v%03d' % (project['name'], sequence['name'], code, v + 1)
+                        sg_versions.append({'type': 'Version', 'id': version_id, 'name': name,
+                                            'updated_at': updated_at + datetime.timedelta(seconds=shot_id)})
+                        version_id += 1
+                        if v < versions - 1:
+                            self.add_folder(shot_path + u'/' + name)
+                    for e in range(extra_folders):
+                        self.add_folder(shot_path + u'/work%d' % e)
+                    self.shots.append({
+                        'type': 'Shot', 'id': shot_id, 'code': code,
+                        'project': project, 'sg_sequence': sequence, 'sg_versions': sg_versions,
+                        'sg_status': None, 'sg_status_list': u'fin' if s % 5 == 0 else u'ip',
+                        'updated_at': updated_at + datetime.timedelta(seconds=shot_id)})
+                    shot_id += 1
+
+    def add_folder(self, path):
+        # Add a folder and its missing parents
+        parent, name = path.rsplit(u'/', 1)
+        if parent and parent not in self.children:
+            self.add_folder(parent)
+        if path not in self.children:
+            self.children[path] = []
+            self.children[parent or u'/'].append(path)
+            self.mtimes[parent or u'/'] += 1
+
+    def subtree(self, path):
+        paths = [path]
+        for child in self.children.get(path, ()):
+            paths.extend(self.subtree(child))
+        return paths
+
+    def add_category(self, name):
+        with self.lock:
+            if name in self.categories:
+                raise Exception('Tag category already exists: %s' % name)
+            self.categories[name] = self.next_id
+            self.tags[name] = {}
+            self.next_id += 1
+            return self.categories[name]
+
+    def add_tag(self, category, name):
+        with self.lock:
+            if category not in self.categories:
+                self.add_category(category)
+            if name in self.tags[category]:
+                raise Exception('Tag already exists: %s/%s' % (category, name))
+            tag = Record(id=self.next_id, name=name, category=category, expiration=None)
+            self.tags[category][name] = tag
+            self.tags_by_id[tag.id] = tag
+            self.next_id += 1
+            return tag
+
+    def add_tag_to_folder(self, path, category, name):
+        if name not in self.tags.get(category, {}):
+            self.add_tag(category, name)
+        self.set_folder_tags(path, self.folder_tags[path] | set([u'%s/%s' % (category, name)]))
+
+    def set_folder_tags(self, path, tags):
+        with self.lock:
+            for tag in self.folder_tags[path]:
+                self.tag_paths[tag].discard(path)
+            self.folder_tags[path] = set(tags)
+            for tag in tags:
+                self.tag_paths[tag].add(path)
+
+
+class FastStatRequest(object):
+    ALL_PATHS = 'ALL_PATHS'
+
+    def __init__(self):
+        self.resultType = None
+        self.requests = []
+
+
+class SubRequest(object):
+    def __init__(self):
+        self.filters = []
+
+
+class TagFilter(object):
+    def __init__(self, tagIds):
+        self.tagIds = list(tagIds)
+
+
+class TagCategoryData(Record):
+    pass
+
+
+class TagData(Record):
+    pass
+
+
+class ClarityNowConnection(object):
+    site = None
+
+    def __init__(self, username, password, server):
+        _count('cn.connect')
+        self.site = ClarityNowConnection.site
+
+    def getVolumes(self):
+        _count('cn.getVolumes')
+        return [Record(name=VOLUME, mount=u'/mnt/' + VOLUME)]
+
+    def getTags(self, category):
+        _count('cn.getTags')
+        if category not in self.site.tags:
+            raise Exception('Tag category not found: %s' % category)
+        return list(self.site.tags[category].values())
+
+    def getTagCategory(self, name):
+        _count('cn.getTagCategory')
+        if name not in self.site.categories:
+            raise Exception('Tag category not found: %s' % name)
+        return Record(id=self.site.categories[name], name=name)
+
+    def addTagCategory(self, data):
+        _count('cn.addTagCategory')
+        return self.site.add_category(data.name)
+
+    def getTag(self, category, name):
+        _count('cn.getTag')
+        return self.site.tags[category][name]
+
+    def addTag(self, category, data):
+        _count('cn.addTag')
+        return self.site.add_tag(category, data.name).id
+
+    def changeTag(self, tag):
+        _count('cn.changeTag')
+
+    def bulkGetImpliedTags(self, tags):
+        _count('cn.bulkGetImpliedTags')
+        return [list(self.site.implied_tags.get(tag, ())) for tag in tags]
+
+    def bulkImpliedTagUpdate(self, tagsToAdd=(), tagsToDelete=()):
+        _count('cn.bulkImpliedTagUpdate')
+        with self.site.lock:
+            for parent, tags in tagsToDelete:
+                self.site.implied_tags[parent] = [tag for tag in self.site.implied_tags[parent] if tag not in tags]
+            for parent, tags in tagsToAdd:
+                for tag in tags:
+                    if tag not in self.site.implied_tags[parent]:
+                        self.site.implied_tags[parent].append(tag)
+
+    def report(self, request):
+        # Folders below a tagged folder are reported along with it
+        _count('cn.report')
+        result = Record(requests=[])
+        for subRequest in request.requests:
+            paths = set()
+            for tagFilter in subRequest.filters:
+                for tag_id in tagFilter.tagIds:
+                    tag = self.site.tags_by_id.get(tag_id)
+                    if tag is None:
+                        continue
+                    for path in self.site.tag_paths.get(u'%s/%s' % (tag.category, tag.name), ()):
+                        paths.update(self.site.subtree(path))
+            result.requests.append(Record(results=[Record(paths=[Record(path=path) for path in sorted(paths)])]))
+        return result
+
+    def enumerateFolderFromDb(self, path):
+        _count('cn.enumerateFolderFromDb')
+        if path not in self.site.children:
+            raise Exception('path not in db')
+        return [Record(name=child.rsplit(u'/', 1)[1], fileType='FOLDER', mtime=self.site.mtimes[child]) for child in self.site.children[path]]
+
+    def bulkSetTagsForFolder(self, updates):
+        _count('cn.bulkSetTagsForFolder')
+        for path, tags in updates:
+            if path not in self.site.children:
+                raise Exception('path not in db: %s' % path)
+        for path, tags in updates:
+            self.site.set_folder_tags(path, tags)
+
+
+def _get_field(entity, field):
+    value = entity
+    for name in field.split('.'):
+        if value is None:
+            return None
+        if name[:1].isupper():
+            continue
+        if isinstance(value, list):
+            # Multi-entity field, the values of every entity
+            value = [v.get(name) for v in value]
+        else:
+            value = value.get(name)
+    return value
+
+
+def _matches(entity, condition):
+    if isinstance(condition, dict):
+        results = [_matches(entity, c) for c in condition['filters']]
+        return any(results) if condition.get('filter_operator') == 'any' else all(results)
+    field, operator, value = condition[0], condition[1], condition[2]
+    if field == 'sg_sequence.Sequence.code':
+        field = 'sg_sequence.Sequence.name'
+    current = _get_field(entity, field)
+    if operator == 'in':
+        if isinstance(current, dict):
+            return current.get('id') in [v['id'] if isinstance(v, dict) else v for v in value]
+        return current in value
+    if operator == 'is':
+        if isinstance(current, dict) and isinstance(value, dict):
+            return current.get('id') == value.get('id')
+        return current == value
+    if operator == 'greater_than':
+        if isinstance(current, list):
+            return any(v is not None and v > value for v in current)
+        return current is not None and current > value
+    raise ValueError('Unsupported filter operator: %s' % operator)
+
+
+class Shotgun(object):
+    site = None
+
+    def __init__(self, base_url, script_name=None, api_key=None, **kwargs):
+        _count('sg.connect')
+        self.site = Shotgun.site
+        self._last_query = None
+
+    def _entities(self, entity_type):
+        if entity_type == 'Shot':
+            return self.site.shots
+        if entity_type == 'EventLogEntry':
+            return self.site.events
+        if entity_type == 'Version':
+            versions = []
+            for shot in self.site.shots:
+                for version in shot['sg_versions']:
+                    versions.append(dict(version, entity={'type': 'Shot', 'id': shot['id']}))
+            return versions
+        return []
+
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False, page=0, **kwargs):
+        _count('sg.find.%s' % entity_type)
+        # Pages of the same query are served from the last filtered result
+        query = repr((entity_type, filters, order, filter_operator))
+        if self._last_query is None or self._last_query[0] != query:
+            entities = [e for e in self._entities(entity_type)
+                        if (any if filter_operator == 'any' else all)(_matches(e, c) for c in filters)]
+            for sort in reversed(order or [{'field_name': 'id', 'direction': 'asc'}]):
+                entities.sort(key=lambda e: _get_field(e, sort['field_name']), reverse=(sort.get('direction') == 'desc'))
+            self._last_query = (query, entities)
+        entities = self._last_query[1]
+        if limit:
+            start = (max(page, 1) - 1) * limit
+            entities = entities[start:start + limit]
+        fields = ['type', 'id'] + list(fields or [])
+        return [dict((field, entity.get(field)) for field in fields) for entity in entities]
+
+    def close(self):
+        pass
+
+
+def install(site):
+    """Register the fake claritynowapi and shotgun_api3 modules, backed by site"""
+    ClarityNowConnection.site = site
+    Shotgun.site = site
+    claritynowapi = types.ModuleType('claritynowapi')
+    for name in ('ClarityNowConnection', 'FastStatRequest', 'SubRequest', 'TagFilter', 'TagCategoryData', 'TagData'):
+        setattr(claritynowapi, name, globals()[name])
+    shotgun_api3 = types.ModuleType('shotgun_api3')
+    shotgun_api3.Shotgun = Shotgun
+    sys.modules['claritynowapi'] = claritynowapi
+    sys.modules['shotgun_api3'] = shotgun_api3
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Client-side API limits for the Shotgun plugin
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: keeps the calls to the ClarityNow and Shotgun APIs within a rate budget shared by all
+# the connections of a process, and retries the calls answered with a throttling response after
+# the delay requested by the server, or an exponential backoff
+# Notes:
+# - Time spent waiting is recorded in the "<backend>_throttle" phase of the run metrics
+# - Only throttling responses are retried, the server did not handle the call
+
+import email.utils
+import random
+import threading
+import time
+
+# HTTP statuses of throttling responses
+THROTTLING_STATUSES = (429, 503)
+# Backoff before the first retry of a throttled call without Retry-After, doubled on each retry
+RETRY_BACKOFF = 1.0
+MAX_RETRY_BACKOFF = 60.0
+# Client methods which do not call the API
+UNLIMITED_METHODS = ('close',)
+
+
+def get_throttling(error):
+    # Get the (HTTP status, Retry-After seconds or None) of a throttling response behind an API error
+    # Returns None for other errors
+    # shotgun_api3 raises ProtocolError (errcode, headers), urllib2 HTTPError (code, headers) and
+    # requests HTTPError (response.status_code, response.headers)
+    response = getattr(error, 'response', None)
+    for status in (getattr(error, 'errcode', None), getattr(error, 'code', None), getattr(response, 'status_code', None)):
+        if status in THROTTLING_STATUSES:
+            break
+    else:
+        return None
+    headers = getattr(error, 'headers', None) or getattr(response, 'headers', None) or {}
+    try:
+        value = headers.get('Retry-After')
+    except AttributeError:
+        value = None
+    return status, parse_retry_after(value)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=0):
+        # rate: calls per second, 0 for unlimited
+        # burst: calls allowed at once after an idle period, defaults to one second of calls
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def split(self, parts):
+        # Bucket holding a share of the budget, for one of several processes
+        return TokenBucket(self.rate / parts, max(1.0, self.burst / parts) if self.rate else 0)
+
+    def is_limited(self):
+        # Whether a call may have to wait
+        return bool(self.rate) or self.paused_until > time.time()
+
+    def take(self):
+        # Take a token, waiting for one if needed
+        # Returns the number of seconds waited
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if not self.rate:
+                        return waited
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        # Hold every call for seconds, after a throttling response
+        # No burst is allowed once the pause ends
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+
+class RateLimitedClient:
+    """Proxy to an API client taking a token from bucket before each method call, and retrying the
+    calls answered with a throttling response at most max_retries times"""
+
+    def __init__(self, client, backend, bucket, max_retries, metrics, on_throttled=None):
+        self._client = client
+        self._backend = backend
+        self._bucket = bucket
+        self._max_retries = max_retries
+        self._metrics = metrics
+        # Called with (backend, method, HTTP status, delay, retry number) before each retry
+        self._on_throttled = on_throttled
+
+    def _take(self):
+        if not self._bucket.is_limited():
+            return
+        with self._metrics.phase('%s_throttle' % self._backend):
+            waited = self._bucket.take()
+        if waited:
+            self._metrics.count('%s_rate_limited_calls' % self._backend)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name in UNLIMITED_METHODS:
+            return attribute
+
+        def call(*args, **kwargs):
+            retry = 0
+            while True:
+                self._take()
+                try:
+                    return attribute(*args, **kwargs)
+                except Exception as e:
+                    throttling = get_throttling(e)
+                    if throttling is None or retry >= self._max_retries:
+                        raise
+                    retry += 1
+                    status, delay = throttling
+                    if delay is None:
+                        delay = min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** (retry - 1)) * random.uniform(0.5, 1.0)
+                    self._metrics.count('%s_throttled_calls' % self._backend)
+                    if self._on_throttled is not None:
+                        self._on_throttled(self._backend, name, status, delay, retry)
+                    self._bucket.pause(delay)
+        return call
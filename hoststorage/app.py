@@ -17,6 +17,18 @@ Environment Variables:
         to the dirname of PLUGIN_DEFAULT_YAML.
     STATIC_FOLDER: The absolute path to the Flask static resources.
     TEMPLATE_FOLDER: The absolute path to the Flask template resources.
+    SHOTGUN_WEBHOOK_SECRET: The secret of the Shotgun webhook sending Shot and Version
+        events to /webhooks/shotgun/. The endpoint is disabled when not set.
+    SHOTGUN_WEBHOOK_WINDOW: Seconds during which webhook deliveries are coalesced
+        before the affected shots are updated. Defaults to 5.
+    SHOTGUN_WEBHOOK_QUEUE_SIZE: Maximum number of pending shot and version ids, a full
+        sweep is run instead when exceeded. Defaults to 10000.
+
+Endpoints:
+    /metrics/summary/: JSON summary of the latest cn_shotgun.py run (phase durations,
+        API calls and item counts), as written to PLUGIN_WORKING_DIR by the script.
+    /webhooks/shotgun/: Receives the Shotgun webhook deliveries of Shot and Version
+        events and updates the affected shots only, see webhooks.py.
 
 Notes:
     Do not attempt to use with any multi-process based WSGI container. The
@@ -26,11 +38,16 @@ Notes:
 import logging
 import os
 
+from flask import jsonify
+
 from dataiq.plugin.user import HardcodedAdminUser
 from dataiq.plugin.util import get_env_or_warn
 
 from legacy.async_executor import AsyncExecutor
 
+from run_metrics import load_summary
+from webhooks import UpdateQueue, create_blueprint
+
 logging.getLogger().setLevel(logging.INFO)
 log = logging.getLogger('app')
 
@@ -45,6 +62,9 @@ STATIC_FOLDER = get_env_or_warn(
     'STATIC_FOLDER', log, '/plugin/plugin-legacy/static/')
 TEMPLATE_FOLDER = get_env_or_warn(
     'TEMPLATE_FOLDER', log, '/plugin/plugin-legacy/templates/')
+SHOTGUN_WEBHOOK_SECRET = os.getenv('SHOTGUN_WEBHOOK_SECRET')
+SHOTGUN_WEBHOOK_WINDOW = float(os.getenv('SHOTGUN_WEBHOOK_WINDOW', 5))
+SHOTGUN_WEBHOOK_QUEUE_SIZE = int(os.getenv('SHOTGUN_WEBHOOK_QUEUE_SIZE', 10000))
 
 try:
     # Hostname is assumed to be in the form of: "plugin-<name>-<pod_id>", though the DNS
@@ -65,6 +85,22 @@ app = AsyncExecutor(
     template_folder=TEMPLATE_FOLDER
 )
 
+# The plugin script runs on Python 2.7, webhook updates run it through the resident worker client
+webhook_queue = UpdateQueue(
+    command=['python2.7', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cn_shotgun_client.py')],
+    max_size=SHOTGUN_WEBHOOK_QUEUE_SIZE,
+    batch_window=SHOTGUN_WEBHOOK_WINDOW
+)
+app.register_blueprint(create_blueprint(lambda: SHOTGUN_WEBHOOK_SECRET, webhook_queue))
+
+
+@app.route('/metrics/summary/')
+def metrics_summary():
+    summary = load_summary(PLUGIN_WORKING_DIR)
+    if summary is None:
+        return jsonify(error='No run summary available yet'), 404
+    return jsonify(summary)
+
 
 if __name__ == '__main__':
     app.run()
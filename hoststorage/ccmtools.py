@@ -32,6 +32,7 @@ import os.path
 from StringIO import StringIO
 import sys
 import syslog
+import threading
 
 CNUSER = "root"
 CNPASS = ""
@@ -332,6 +333,78 @@ class CcmLog:
     def close (self):
         syslog.closelog()
 
+class PathPrefixMap:
+    """Replace the longest matching prefix of paths, over a trie of path components"""
+
+    """Prefixes end with '/', a path matches the same prefixes as with startswith()"""
+    # The trie is made of dicts keyed by path component, the None key holds the
+    # (prefix length, replacement) of the prefix ending at that node. Among equal
+    # prefixes, as in many-to-one server maps, the first one is kept
+    # cacheSize > 0 keeps the translations of the most recently used paths, in a dict
+    # and a circular doubly linked list of [previous, next, path, translation] links
+    # ordered from the least to the most recently used
+    # decode=True accepts str paths, decoded from UTF-8 before the lookup. The cache is
+    # keyed by the path as given, so a cached path is not decoded again
+    def __init__ (self, pairs, cacheSize=0, decode=False):
+        self.trie = {}
+        for prefix, replacement in pairs:
+            node = self.trie
+            for part in prefix.split('/')[:-1]:
+                node = node.setdefault(part, {})
+            if None not in node:
+                node[None] = (len(prefix), replacement)
+        self.decode = decode
+        self.cacheSize = cacheSize
+        self.cache = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+
+    def _translate (self, path):
+        if self.decode and type(path) is not unicode:
+            path = unicode(path, encoding="UTF-8")
+        node = self.trie
+        match = None
+        parts = path.split('/')
+        # A prefix of k components only matches when a '/' follows them in the path
+        for i in range(len(parts) - 1):
+            node = node.get(parts[i])
+            if node is None:
+                break
+            match = node.get(None, match)
+        if match is None:
+            raise LookupError('Cannot convert path.')
+        return match[1] + path[match[0]:]
+
+    def translate (self, path):
+        if not self.cacheSize:
+            return self._translate(path)
+        with self.lock:
+            link = self.cache.get(path)
+            if link is not None:
+                # Move the link to the most recently used end
+                previous, following = link[0], link[1]
+                previous[1] = following
+                following[0] = previous
+                last = self.root[0]
+                last[1] = self.root[0] = link
+                link[0] = last
+                link[1] = self.root
+                return link[3]
+        result = self._translate(path)
+        with self.lock:
+            if path not in self.cache:
+                if len(self.cache) >= self.cacheSize:
+                    # Drop the least recently used link
+                    oldest = self.root[1]
+                    self.root[1] = oldest[1]
+                    oldest[1][0] = self.root
+                    del self.cache[oldest[2]]
+                last = self.root[0]
+                link = [last, self.root, path, result]
+                last[1] = self.root[0] = self.cache[path] = link
+        return result
+
 class ServerMap:
     """Translate paths using ClarityNow's volume configuration"""
 
@@ -342,7 +415,7 @@ class ServerMap:
     #     root            /
     #     test1           /mnt/test
     #     test2           /mnt/test/
-    def __init__ (self,api):
+    def __init__ (self,api,cacheSize=0):
         self.serverMapNM = []
         self.serverMapMN = []
         for vol in api.getVolumes():
@@ -355,29 +428,19 @@ class ServerMap:
             self.serverMapMN.append((mount, name))
         self.serverMapNM.sort(key = lambda nm: len(nm[0]), reverse=True)
         self.serverMapMN.sort(key = lambda mn: len(mn[0]), reverse=True)
+        self.serverTrieNM = PathPrefixMap(self.serverMapNM, cacheSize, decode=True)
+        self.serverTrieMN = PathPrefixMap(self.serverMapMN, cacheSize, decode=True)
 
-    def getPfilepath (self, nameFP): #nameFP should be unicode
-        if type(nameFP) is not unicode:
-            nameFP = unicode(nameFP, encoding="UTF-8")
-        # print (nameFP,self.serverMapNM)
-        for n,m in self.serverMapNM:
-            # print (n,m)
-            if nameFP.startswith(n):
-                return m + nameFP[len(n):]
-        raise LookupError('Cannot convert path.')
+    def getPfilepath (self, nameFP): #nameFP should be unicode, str is decoded from UTF-8
+        return self.serverTrieNM.translate(nameFP)
     def getVfilepath (self, mountFP):
-        if type(mountFP) is not unicode:
-            mountFP = unicode(mountFP, encoding="UTF-8")
-        for m,n in self.serverMapMN:
-            if mountFP.startswith(m):
-                return n + mountFP[len(m):]
-        raise LookupError('Cannot convert path.')
+        return self.serverTrieMN.translate(mountFP)
 
 class ClientMap:
     """Translate paths using ClarityNow's client map config file"""
 
     """Clientmap file may have various maps, but only Linux lookups supported"""
-    def __init__ (self,mapname):
+    def __init__ (self,mapname,cacheSize=0):
         self.groups = {}
         group = None
         with codecs.open(CLIENTMAP, 'r', encoding='UTF-8') as mf:
@@ -405,19 +468,15 @@ class ClientMap:
             self.mapMN.append((mount, name))
         self.mapNM.sort(key = lambda nm: len(nm[0]), reverse=True)
         self.mapMN.sort(key = lambda mn: len(mn[0]), reverse=True)
+        self.trieNM = PathPrefixMap(self.mapNM, cacheSize)
+        self.trieMN = PathPrefixMap(self.mapMN, cacheSize)
 
     def getPfilepath (self, nameFP):
         """Look up client physical path given virtual path"""
-        for n,m in self.mapNM:
-            if nameFP.startswith(n):
-                return m + nameFP[len(n):]
-        raise LookupError('Cannot convert path.')
+        return self.trieNM.translate(nameFP)
     def getVfilepath (self, mountFP):
         """Look up virtual path given client physical path"""
-        for m,n in self.mapMN:
-            if mountFP.startswith(m):
-                return n + mountFP[len(m):]
-        raise LookupError('Cannot convert path.')
+        return self.trieMN.translate(mountFP)
 
     def dump (self):
         for key in self.groups:
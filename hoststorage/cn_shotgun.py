@@ -27,6 +27,19 @@ LOGGING_NAME = 'legacy.%s' % IDENT
 # Get the current platform from the environment variable SHOTGUN_PLUGIN_MODE. Available options: "cn", "dataiq"
 # Default is cn
 PLATFORM_MODE = os.environ.get('SHOTGUN_PLUGIN_MODE', 'dataiq')
+# Name of the file holding the plugin state between runs, in PLUGIN_WORKING_DIR
+STATE_FILE = 'cn_shotgun_state.json'
+# Shots updated this many seconds before the watermark are fetched again, to cover
+# shots being updated while the previous run was fetching
+WATERMARK_OVERLAP = 300
+# Name of the unix socket of the resident worker, in PLUGIN_WORKING_DIR
+# Keep in sync with cn_shotgun_client.py
+SOCKET_FILE = 'cn_shotgun.sock'
+# Selections of at most this many shot folders look their shot tags up by name, instead of
+# listing every shot tag
+MAX_SHOT_TAG_LOOKUPS = 100
+# ClarityNow folder attributes changing when subfolders are added, removed or renamed
+FINGERPRINT_ATTRIBUTES = ('mtime', 'ctime', 'numFolders')
 
 import sys
 sys.path.append('/usr/local/claritynow/scripts/python')
@@ -34,9 +47,45 @@ import claritynowapi
 import ccmtools
 import traceback
 import socket
+import logging
+import argparse
 import datetime
 import time
+import calendar
+import json
+import itertools
+import bisect
+import copy
+import hashlib
+import threading
+import multiprocessing
+import Queue
 import shotgun_api3
+from run_metrics import RunMetrics, InstrumentedClient
+from shot_cache import ShotCache, CachedPath, CACHE_FILE
+from shot_records import ShotRecordFactory
+from shot_names import ShotNameRule
+from run_lock import RunLock
+from api_limits import TokenBucket, RateLimitedClient
+
+def chunks(items, size):
+    # Split an iterable in lists of at most size items
+    iterator = iter(items)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+def parse_ids(value):
+    # Parse a comma separated list of shotgun entity ids
+    try:
+        return [int(i) for i in value.split(',') if i.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid id list: %s' % value)
+
+def get_working_dir(scriptFilePath):
+    # Directory holding the plugin state between runs
+    return os.environ.get('PLUGIN_WORKING_DIR') or scriptFilePath or '.'
 
 class ShotgunPlugin:
     def __init__(self, scriptFilePath):
@@ -44,20 +93,34 @@ class ShotgunPlugin:
         self.SHOT_TAG_CAT = 'shot'
         self.SHOT_STATUS_CAT = 'shotgun_status'
         self.SHOT_VERSION_CAT = 'shotgun_version'
+        # Shotgun shot fields used by the plugin
+        self.SHOT_FIELDS = ['code', 'project', 'sg_sequence', 'sg_versions', 'sg_status_list', 'updated_at']
+        #self.SHOT_FIELDS = ['code', 'project', 'sg_sequence', 'sg_versions', 'sg_status', 'sg_status_list', 'assets', 'addressings_cc', 'sg_cut_duration', 'sg_cut_in', 'sg_cut_order', 'sg_cut_out' ,'description', 'id', 'open_notes_count', 'sg_shot_type', 'task_template', 'created_by', 'created_at', 'updated_at', 'updated_by', 'tags']
+        # Shotgun events triggering an update in daemon mode
+        self.SHOT_EVENT_TYPES = ['Shotgun_Shot_New', 'Shotgun_Shot_Change', 'Shotgun_Version_New', 'Shotgun_Version_Change']
         # CN Server settings
         self.CNSERVER = 'localhost'
+        # Directory holding the plugin state between runs
+        self.working_dir = get_working_dir(scriptFilePath)
+        # Durations, API calls and item counts of the current run
+        self.metrics = RunMetrics()
         # CN config
         self.cncfg = ccmtools.CcmConfig(scriptFilePath, IDENT)
         self.dataiqcfg = self._get_dataiq_cfg()
+        # Client-side API limits, shared by all the connections to each backend: calls per second
+        # (0 for unlimited), burst of calls after an idle period and retries of throttled calls
+        self.api_limits = {}
+        self.api_max_retries = {}
+        for backend in ('claritynow', 'shotgun'):
+            self.api_limits[backend] = TokenBucket(float(self._get_from_config(backend + 'RateLimit') or 0),
+                                                   float(self._get_from_config(backend + 'RateBurst') or 0))
+            self.api_max_retries[backend] = int(self._get_from_config(backend + 'MaxRetries') or 5)
         # Prepare connection to ClarityNow server
-        username, password = self.cncfg.getCredentials()
-        self.api = claritynowapi.ClarityNowConnection(username, password, self.CNSERVER)
-        self.server_map = ccmtools.ServerMap(self.api)
+        self.api = self._connect_claritynow()
         # Prepare logging
         self.debug = (self._get_from_config('debug') == "True")
         self.facility = self._get_from_config('facility')
         if PLATFORM_MODE == 'dataiq':
-            import logging
             logging.basicConfig()
             logging.getLogger().setLevel(self.debug)
             self.log = logging.getLogger(LOGGING_NAME)
@@ -67,14 +130,86 @@ class ShotgunPlugin:
         self.shotgun_api_url = self._get_from_config('shotgunAPIUrl')
         self.shotgun_api_script_name = self._get_from_config('shotgunAPIScriptName')
         self.shotgun_api_key = self._get_from_config('shotgunAPIKey')
-        self.sg = shotgun_api3.Shotgun('https://'+self.shotgun_api_url, script_name=self.shotgun_api_script_name, api_key=self.shotgun_api_key)
+        self.sg = self._connect_shotgun()
+        self.streaming_fetch = (str(self._get_from_config('streamingFetch')) == "True")
+        self.shotgun_page_size = int(self._get_from_config('shotgunPageSize') or 500)
+        self.shotgun_concurrency = int(self._get_from_config('shotgunConcurrency') or 4)
+        # How the shot tag names map to the shotgun shots: the apply_tag template of the autotag rule,
+        # or a regular expression with project, sequence and shot groups
+        self.shot_names = ShotNameRule(self._get_from_config('shotTagTemplate') or '$1_$2_$3',
+                                       self._get_from_config('shotTagPattern') or None)
+        # Restrict the Shot query to the projects or sequences found in the shot tags: "none", "project" or "sequence"
+        self.shotgun_query_filter = self._get_from_config('shotgunQueryFilter') or 'project'
+        self.shotgun_filter_chunk_size = int(self._get_from_config('shotgunFilterChunkSize') or 100)
+        # Number of shots handled together by bulk ClarityNow requests
+        self.claritynow_batch_size = int(self._get_from_config('claritynowBatchSize') or 1000)
+        # Number of batches handled at the same time, each over its own ClarityNow connection
+        self.claritynow_concurrency = int(self._get_from_config('claritynowConcurrency') or 1)
+        # Number of worker processes sharing the shot tags of a sweep, each over its own connections
+        self.shard_processes = int(self._get_from_config('shardProcesses') or 1)
+        # Projects with more shot tags are split over several shards, 0 splits the projects larger than a shard
+        self.shard_max_shot_tags = int(self._get_from_config('shardMaxShotTags') or 0)
+        # Maximum number of updates committed to ClarityNow with a single request
+        self.commit_batch_size = int(self._get_from_config('commitBatchSize') or 5000)
+        # How the subfolders of the shot folders are discovered: "enumerate" lists each shot folder,
+        # "sequence" lists the shots folder of each sequence and only the shot folders which changed
+        self.version_discovery = self._get_from_config('versionDiscovery') or 'enumerate'
+        # Keep the shot folder of each shot tag between runs
+        self.cache_shot_paths = (str(self._get_from_config('shotPathCache')) == "True")
+        # Only list the shot folders whose attributes or shotgun versions changed since the last run
+        self.skip_unchanged_shots = (str(self._get_from_config('skipUnchangedShots')) == "True")
+        self.shot_cache = None
+        if self.cache_shot_paths or self.skip_unchanged_shots or self.version_discovery == 'sequence':
+            self.shot_cache = ShotCache(os.path.join(self.working_dir, CACHE_FILE))
         # Plugin utils
+        self._reset_run()
+        self.expiration_delay = self._get_from_config('expirationDelay')
+        self.shotgun_status_finalized = 'fin'
+        # Incremental sync settings
+        self.incremental_sync = (str(self._get_from_config('incrementalSync')) == "True")
+        self.full_resync_interval = self._get_from_config('fullResyncInterval')
+        # Daemon mode settings, in seconds
+        self.event_poll_interval = float(self._get_from_config('eventPollInterval') or 10)
+        self.event_batch_window = float(self._get_from_config('eventBatchWindow') or 5)
+        # Seconds after which the lock of a run on another host, or of a hung run, is considered stale
+        self.stale_lock_timeout = float(self._get_from_config('staleLockTimeout') or 600)
+
+    def _reset_run(self):
+        # Clear what was collected by the previous run
         self.unique_tags_to_create = set()
         self.implied_tag_updates = []
         self.implied_tags_to_delete = []
         self.tag_updates = []
-        self.expiration_delay = self._get_from_config('expirationDelay')
-        self.shotgun_status_finalized = 'fin'
+        self.last_updated_at = None
+        self.implied_tags = {}
+        self.shot_paths = {}
+        self.resolved_shot_paths = {}
+        self.tag_catalog = {}
+        self.version_folder_candidates = []
+        self.shot_fingerprints = {}
+        self.shot_folder_entries = {}
+        self.shot_folder_attributes = {}
+        self.shot_subfolders = {}
+        self.listed_subfolders = []
+        self.shot_records = ShotRecordFactory()
+
+    def _connect_claritynow(self):
+        username, password = self.cncfg.getCredentials()
+        api = claritynowapi.ClarityNowConnection(username, password, self.CNSERVER)
+        return self._limit_client(api, 'claritynow')
+
+    def _connect_shotgun(self):
+        sg = shotgun_api3.Shotgun('https://'+self.shotgun_api_url, script_name=self.shotgun_api_script_name, api_key=self.shotgun_api_key)
+        return self._limit_client(sg, 'shotgun')
+
+    def _limit_client(self, client, backend):
+        # Keep the calls of a client within the limits of its backend, and record them in the run metrics
+        return RateLimitedClient(InstrumentedClient(client, backend, self.metrics), backend, self.api_limits[backend],
+                                 self.api_max_retries[backend], self.metrics, self._log_throttled_call)
+
+    def _log_throttled_call(self, backend, method, status, delay, retry):
+        self.log.warning(self._format_log(('%s throttled %s with HTTP %d' % (backend, method, status),
+                                           'Retry %d in %.1fs' % (retry, delay))))
 
     def _format_log(self, log_tuple):
         if PLATFORM_MODE == 'dataiq':
@@ -96,63 +231,353 @@ class ShotgunPlugin:
     def _retrieve_shot_tags(self):
         return self.api.getTags(self.SHOT_TAG_CAT)
 
-    def _retrieve_shotgun_shots(self):
-        fields = ['code', 'project', 'sg_sequence', 'sg_versions', 'sg_status', 'sg_status_list']
-        #fields = ['code', 'project', 'sg_sequence', 'sg_versions', 'sg_status', 'sg_status_list', 'assets', 'addressings_cc', 'sg_cut_duration', 'sg_cut_in', 'sg_cut_order', 'sg_cut_out' ,'description', 'id', 'open_notes_count', 'sg_shot_type', 'task_template', 'created_by', 'created_at', 'updated_at', 'updated_by', 'tags']
-        filters = []
-        return self.sg.find('Shot', filters, fields)
+    def _load_state(self):
+        # Read the state persisted by the previous runs
+        try:
+            with open(os.path.join(self.working_dir, STATE_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
 
-    def _find_shotgun_shot_by_unique_name(self, name, shots):
-        # Find a shotgun shot using the tag unique id name from CN
-        # Returns None if no version is found
-        splitted_name = name.split('_')
-        if len(splitted_name) != 3:
-            return None
+    def _update_state(self, **values):
+        # Update some values of the persisted state, keeping the values saved by other modes
+        # The state is read and written under the guard of the run lock, as the daemon and the
+        # sweeps of other processes update it at the same time
+        with RunLock(self.working_dir, self.stale_lock_timeout).guard():
+            state = self._load_state()
+            state.update(values)
+            self._save_state(state)
+
+    def _save_state(self, state):
+        # Persist the state for the next runs, replacing the state file atomically
+        state_path = os.path.join(self.working_dir, STATE_FILE)
+        temp_path = '%s.%d.tmp' % (state_path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(state, f)
+            os.rename(temp_path, state_path)
+        except (IOError, OSError):
+            self.log.error(self._format_log(('Failed to save plugin state', state_path)))
+
+    def _is_full_sync_due(self, state):
+        # A full sync is run when incremental sync is disabled, when there is no watermark yet
+        # and every fullResyncInterval days to catch changes missed by the incremental runs
+        if not self.incremental_sync or state.get('watermark') is None:
+            return True
+        if not self.full_resync_interval:
+            return False
+        last_full_sync = state.get('last_full_sync') or 0
+        return time.time() - last_full_sync >= int(self.full_resync_interval) * 86400
+
+    def _to_timestamp(self, value):
+        # Convert a shotgun datetime to a POSIX timestamp
+        if value.tzinfo is not None:
+            return calendar.timegm(value.utctimetuple())
+        return time.mktime(value.timetuple())
+
+    def _get_shot_tag_scopes(self, shot_tags):
+        # Map the candidate project names of the shot tags to their candidate sequence names
+        # Names may contain underscores, so every candidate key of a tag name is kept
+        scopes = {}
+        for shot_tag in shot_tags:
+            for project, sequence, code in self.shot_names.parse(shot_tag.name):
+                scopes.setdefault(project, set()).add(sequence)
+        return scopes
+
+    def _get_shot_filter_sets(self, shot_tags):
+        # Build the filters restricting the Shot query to the projects (and sequences) of the shot tags
+        # Names are split over several queries of at most shotgunFilterChunkSize names
+        # Returns one filter list per query
+        if self.shotgun_query_filter == 'none':
+            return [[]]
+        scopes = self._get_shot_tag_scopes(shot_tags)
+        filter_sets = []
+        for projects in chunks(sorted(scopes), self.shotgun_filter_chunk_size):
+            project_filter = ['project.Project.name', 'in', projects]
+            if self.shotgun_query_filter == 'sequence':
+                sequences = set()
+                for project in projects:
+                    sequences.update(scopes[project])
+                for sequence_chunk in chunks(sorted(sequences), self.shotgun_filter_chunk_size):
+                    filter_sets.append([project_filter, ['sg_sequence.Sequence.code', 'in', sequence_chunk]])
+            else:
+                filter_sets.append([project_filter])
+        return filter_sets
+
+    def _retrieve_shotgun_shots(self, shot_tags, updated_since=None):
+        # Fetch the shotgun shots which may match the shot tags
+        # Only the ones updated after the updated_since timestamp are fetched if given, along with
+        # the ones with a version created or updated since, as linking a version to a shot does
+        # not change the updated_at of the shot
+        fields = self.SHOT_FIELDS
+        base_filters = []
+        if updated_since is not None:
+            since = datetime.datetime.fromtimestamp(updated_since - WATERMARK_OVERLAP)
+            base_filters.append({'filter_operator': 'any', 'filters': [['updated_at', 'greater_than', since],
+                                                                       ['sg_versions.Version.updated_at', 'greater_than', since]]})
+        filter_sets = self._get_shot_filter_sets(shot_tags)
+        if self.streaming_fetch:
+            return self._compact_shots(itertools.chain.from_iterable(self._stream_shotgun_shots(base_filters + filters, fields) for filters in filter_sets))
+        shots = []
+        for filters in filter_sets:
+            shots.extend(self._compact_shots(self._page_shotgun_shots(base_filters + filters, fields)))
+        return shots
+
+    def _page_shotgun_shots(self, filters, fields):
+        # Fetch shotgun shots one page of shotgunPageSize shots after the other, so that only the
+        # current page is held as shotgun dicts while the shots are compacted
+        for page in itertools.count(1):
+            shots = self.sg.find('Shot', filters, fields, order=[{'field_name': 'id', 'direction': 'asc'}], limit=self.shotgun_page_size, page=page)
+            for shot in shots:
+                yield shot
+            if len(shots) < self.shotgun_page_size:
+                return
+
+    def _stream_shotgun_shots(self, filters, fields):
+        # Fetch shotgun shots page by page over shotgunConcurrency connections
+        # Shots are yielded as soon as their page is received, in no particular order
+        # At most shotgunConcurrency pages are fetched or waiting to be consumed at any time
+        pages = Queue.Queue(maxsize=self.shotgun_concurrency)
+        page_numbers = itertools.count(1)
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def fetch_pages():
+            try:
+                sg = self._connect_shotgun()
+                try:
+                    while not stop.is_set():
+                        with lock:
+                            page = next(page_numbers)
+                        shots = sg.find('Shot', filters, fields, order=[{'field_name': 'id', 'direction': 'asc'}], limit=self.shotgun_page_size, page=page)
+                        pages.put((shots, None))
+                        if len(shots) < self.shotgun_page_size:
+                            break
+                finally:
+                    sg.close()
+            except Exception as e:
+                pages.put((None, e))
+            finally:
+                pages.put(None)
+
+        workers = [threading.Thread(target=fetch_pages) for i in range(self.shotgun_concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            running = len(workers)
+            while running:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                    continue
+                shots, error = page
+                if error is not None:
+                    raise error
+                for shot in shots:
+                    yield shot
+        finally:
+            # Unblock the workers if the consumer stopped early
+            stop.set()
+            while any(worker.is_alive() for worker in workers):
+                try:
+                    pages.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    def _compact_shots(self, shots):
+        # Turn the shots returned by the shotgun API into compact shot records as they are received
+        # Shots without a project or a sequence cannot be matched against a shot tag and are left out
+        for shot in shots:
+            self._track_updated_at(shot)
+            self.metrics.count('shotgun_shots')
+            record = self.shot_records.create(shot)
+            if record is None:
+                self.log.debug(self._format_log(('Shotgun shot %s has no project or sequence' % shot['code'], 'Skipping shot.')))
+                continue
+            yield record
+
+    def _track_updated_at(self, shot):
+        # Keep the most recent update time of the fetched shots for the next incremental sync
+        if shot.get('updated_at'):
+            updated_at = self._to_timestamp(shot['updated_at'])
+            if self.last_updated_at is None or updated_at > self.last_updated_at:
+                self.last_updated_at = updated_at
+
+    def _index_shotgun_shots(self, shots):
+        # Index shotgun shots by (project name, sequence name, shot code)
+        shot_index = {}
         for shot in shots:
-            if shot['code'] == splitted_name[2] and shot['sg_sequence']['name'] == splitted_name[1] and shot['project']['name'] == splitted_name[0]:
+            key = shot.key()
+            if key in shot_index:
+                self.log.warning(self._format_log(('Duplicate shotgun shot %s' % self.shot_names.format(key), 'Keeping the first one.')))
+                continue
+            shot_index[key] = shot
+        return shot_index
+
+    def _index_shotgun_versions(self, shot):
+        # Index the versions of a shotgun shot by name
+        return frozenset(shot.versions)
+
+    def _find_shotgun_shot_by_unique_name(self, name, shot_index):
+        # Find a shotgun shot using the tag unique id name from CN
+        # Project, sequence and shot names may contain underscores themselves,
+        # so every candidate key of the name is looked up
+        # Returns None if no shot is found
+        for key in self.shot_names.parse(name):
+            shot = shot_index.get(key)
+            if shot is not None:
                 return shot
         return None
 
-    def _find_shotgun_version_by_name(self, name, versions):
+    def _find_shotgun_version_by_name(self, name, version_index):
         # Find a shotgun version by name
         # Returns None if no version is found
-        for version in versions:
-            if version['name'] == name:
-                return version
-        return None
+        return name if name in version_index else None
+
+    def _match_shot_tags(self, shot_tags, shots, report_unmatched=True, record_misses=False):
+        # Pair the shot tags with their shotgun shot
+        # Streamed shots are matched as they are received, other shots are indexed first
+        # Shot tags not following the shot tag rule cannot match any shot, they are counted apart
+        # With record_misses, the shot tags not following the rule or matching no shot are recorded
+        # in the shot cache once every shot is matched
+        parsable = [shot_tag for shot_tag in shot_tags if self.shot_names.parse(shot_tag.name)]
+        misses = [shot_tag for shot_tag in shot_tags if not self.shot_names.parse(shot_tag.name)] if record_misses else []
+        if len(parsable) < len(shot_tags):
+            self.metrics.count('unparsable_shot_tags', len(shot_tags) - len(parsable))
+            if report_unmatched:
+                example = next(shot_tag.name for shot_tag in shot_tags if not self.shot_names.parse(shot_tag.name))
+                self.log.warning(self._format_log(('%d shot tags do not follow the shot tag rule' % (len(shot_tags) - len(parsable)),
+                                                   'Skipping them, for instance %s' % example)))
+            shot_tags = parsable
+        if self.streaming_fetch:
+            tags_by_key = {}
+            for shot_tag in shot_tags:
+                for key in self.shot_names.parse(shot_tag.name):
+                    tags_by_key.setdefault(key, shot_tag)
+            matched = set()
+            for shot in shots:
+                shot_tag = tags_by_key.get(shot.key())
+                if shot_tag is None or shot_tag.name in matched:
+                    continue
+                matched.add(shot_tag.name)
+                yield shot_tag, shot
+            unmatched = [shot_tag for shot_tag in shot_tags if shot_tag.name not in matched]
+        else:
+            shot_index = self._index_shotgun_shots(shots)
+            unmatched = []
+            for shot_tag in shot_tags:
+                match = self._find_shotgun_shot_by_unique_name(shot_tag.name, shot_index)
+                if match is None:
+                    unmatched.append(shot_tag)
+                    continue
+                yield shot_tag, match
+        self.metrics.count('unmatched_shot_tags', len(unmatched))
+        if record_misses:
+            misses.extend(unmatched)
+            self.shot_cache.add_shot_tag_misses(self.shot_names.key, [(shot_tag.name, shot_tag.id) for shot_tag in misses])
+        if report_unmatched:
+            for shot_tag in unmatched:
+                self.log.warning(self._format_log(('Unable to find matching shotgun shot for %s' % shot_tag.name, 'Skipping shot.')))
 
     def _get_or_create_category(self, name):
+        # Only called for categories missing from the tag catalog, so the category is added first
+        # If another process added it since the catalog was loaded, the existing one is returned
         try:
-            category_id = self.api.getTagCategory(name).id
-        except:
             category_id = self.api.addTagCategory(claritynowapi.TagCategoryData(name=name))
-            pass
+        except:
+            category_id = self.api.getTagCategory(name).id
         return dict(id=category_id, category_name=name)
 
     def _get_or_create_tag(self, category_name, name):
+        # Only called for tags missing from the tag catalog, so the tag is added first
+        # If another process added it since the catalog was loaded, the existing one is returned
         try:
-            tag = self.api.getTag(category_name, name).id
-        except:
             tag = self.api.addTag(category_name, claritynowapi.TagData(name=name))
-            pass
+        except:
+            tag = self.api.getTag(category_name, name).id
         return dict(id=tag, category_name=category_name, tag_name=name)
 
+    def _get_catalog_category(self, category_name):
+        # Get the existing tags of a category as a name to id map, loading them on first use
+        # Returns None if the category does not exist
+        if category_name not in self.tag_catalog:
+            try:
+                self.tag_catalog[category_name] = dict((tag.name, tag.id) for tag in self.api.getTags(category_name))
+            except:
+                self.tag_catalog[category_name] = None
+        return self.tag_catalog[category_name]
+
     def _update_tag(self, tag_data):
         try:
             self.api.changeTag(tag_data)
         except:
             self.log.error(self._format_log(('Failed to update tag data', tag_data.name)))
 
+    def _prefetch_implied_tags(self, shot_tags):
+        # Get the implied tags of a batch of shot tags in one request
+        # Shot tags missing from the result are fetched one by one by _get_implied_tags_for_tag
+        names = ['{0}/{1}'.format(self.SHOT_TAG_CAT, shot_tag.name) for shot_tag in shot_tags]
+        try:
+            self.implied_tags = dict(zip(names, self.api.bulkGetImpliedTags(names)))
+        except:
+            self.log.error(self._format_log(('Failed to bulk get implied tags', 'Attempting to get them one by one')))
+            self.implied_tags = {}
+
     def _get_implied_tags_for_tag(self, category_name, name):
         # Get the list of implied tag strings for a given parent tab
+        tag = '{0}/{1}'.format(category_name, name)
+        if tag in self.implied_tags:
+            return self.implied_tags[tag]
         try:
-            return self.api.bulkGetImpliedTags(['{0}/{1}'.format(category_name, name)])[0]
+            return self.api.bulkGetImpliedTags([tag])[0]
         except:
             return []
 
+    def _prefetch_shot_paths(self, shot_tags):
+        # Find the paths associated with a batch of shot tags in one report
+        # The report holds one sub request per shot tag, results come back in the same order
+        # Shot tags missing from the result are resolved one by one by _get_shot_path_info_by_tag
+        # With shotPathCache enabled, only the shot tags missing from the cache are resolved
+        # Shot tags whose path was already resolved during the run are not resolved again
+        self.shot_paths = dict((shot_tag.name, self.resolved_shot_paths[shot_tag.name])
+                               for shot_tag in shot_tags if shot_tag.name in self.resolved_shot_paths)
+        shot_tags = [shot_tag for shot_tag in shot_tags if shot_tag.name not in self.shot_paths]
+        if not shot_tags:
+            return
+        if self.cache_shot_paths:
+            cached_paths = self.shot_cache.get_paths(shot_tags)
+            self.metrics.count('shot_path_cache_hits', len(cached_paths))
+            self.shot_paths.update(cached_paths)
+            shot_tags = [shot_tag for shot_tag in shot_tags if shot_tag.name not in cached_paths]
+            self.metrics.count('shot_path_cache_misses', len(shot_tags))
+            if not shot_tags:
+                return
+        try:
+            request = claritynowapi.FastStatRequest()
+            request.resultType = claritynowapi.FastStatRequest.ALL_PATHS
+            for shot_tag in shot_tags:
+                subRequest = claritynowapi.SubRequest()
+                subRequest.filters.append(claritynowapi.TagFilter([shot_tag.id]))
+                request.requests.append(subRequest)
+            result = self.api.report(request)
+        except:
+            self.log.error(self._format_log(('Failed to get the shot paths in bulk', 'Attempting to get them one by one')))
+            return
+        for shot_tag, subResult in zip(shot_tags, result.requests):
+            try:
+                self.shot_paths[shot_tag.name] = subResult.results[0].paths[0]
+            except (IndexError, AttributeError):
+                self.shot_paths[shot_tag.name] = None
+        if self.cache_shot_paths:
+            self.shot_cache.set_paths([(shot_tag.name, shot_tag.id, self.shot_paths[shot_tag.name].path)
+                                       for shot_tag in shot_tags if self.shot_paths.get(shot_tag.name)])
+
     def _get_shot_path_info_by_tag(self, shot_tag):
         # Find path associated with a shot tag
         # We can assume the tag is only applied on one path
+        if shot_tag.name in self.shot_paths:
+            return self.shot_paths[shot_tag.name]
         try:
             request = claritynowapi.FastStatRequest()
             request.resultType = claritynowapi.FastStatRequest.ALL_PATHS
@@ -160,31 +585,153 @@ class ShotgunPlugin:
             subRequest.filters.append(claritynowapi.TagFilter([shot_tag.id]))
             request.requests.append(subRequest)
             result = self.api.report(request)
-            return result.requests[0].results[0].paths[0]
+            path = result.requests[0].results[0].paths[0]
         except:
             return None
+        if self.cache_shot_paths:
+            self.shot_cache.set_paths([(shot_tag.name, shot_tag.id, path.path)])
+        return path
+
+    def _invalidate_shot_path(self, shot_tag):
+        # Forget the cached path of a shot tag, it is resolved again on next use
+        self.metrics.count('shot_path_cache_invalidations')
+        self.shot_cache.delete_path(shot_tag.name)
+        self.shot_paths.pop(shot_tag.name, None)
+        self.resolved_shot_paths.pop(shot_tag.name, None)
+
+    def clear_cache(self):
+        if self.shot_cache is not None:
+            self.log.info(self._format_log(('Shotgun plugin', 'Clearing the shot cache')))
+            self.shot_cache.clear()
 
     def _get_folder_content(self, vpath):
         # List the content of a virtualPath
+        # Returns None if it cannot be listed
         try:
             return self.api.enumerateFolderFromDb(vpath)
         except:
-            return []
+            return None
+
+    def _get_shot_subfolders(self, vpath):
+        # List the names of the subfolders of a shot folder, unless they were recorded by an earlier
+        # run and the shot folder did not change since, see _prefetch_shot_subfolders
+        # Returns None if the shot folder cannot be listed
+        if vpath in self.shot_subfolders:
+            return self.shot_subfolders[vpath]
+        content = self._get_folder_content(vpath)
+        if content is None:
+            return None
+        names = [elem.name for elem in content if elem.fileType == 'FOLDER']
+        if vpath in self.shot_folder_attributes:
+            self.listed_subfolders.append((vpath, self.shot_folder_attributes[vpath], names))
+        return names
+
+    def _get_shot_folder_entries(self, paths):
+        # Get the ClarityNow entries of shot folders by listing their parent folders, so that the
+        # attributes of the shot folders of a sequence come with a single call
+        # Returns a shot folder path to entry map, folders which could not be listed are left out
+        names_by_parent = {}
+        for path in paths:
+            parent, name = os.path.split(path.rstrip('/'))
+            names_by_parent.setdefault(parent, set()).add(name)
+        entries = {}
+        for parent, names in names_by_parent.items():
+            for elem in self._get_folder_content(parent) or ():
+                if elem.name in names and elem.fileType == 'FOLDER':
+                    entries[os.path.join(parent, elem.name)] = elem
+        return entries
+
+    def _prefetch_shot_folder_entries(self, batch):
+        # Get the ClarityNow entries of the shot folders of a batch, see _get_shot_folder_entries
+        paths = (self._get_shot_path_info_by_tag(shot_tag) for shot_tag, shot in batch)
+        self.shot_folder_entries = self._get_shot_folder_entries(path.path for path in paths if path)
+
+    def _get_folder_attributes(self, entry):
+        # Attributes of a folder entry changing when its subfolders change
+        # Returns None if the entry has none of them
+        values = [getattr(entry, name, None) for name in FINGERPRINT_ATTRIBUTES]
+        if all(value is None for value in values):
+            return None
+        return [repr(value) for value in values]
+
+    def _get_shot_fingerprint(self, path, entry, shot):
+        # Fingerprint of a shot folder and of the shotgun versions it is matched against
+        # Returns None if the folder attributes cannot tell whether its subfolders changed
+        attributes = self._get_folder_attributes(entry)
+        if attributes is None:
+            return None
+        versions = sorted(shot.versions)
+        return hashlib.sha1(json.dumps([path, attributes, versions]).encode('utf8')).hexdigest()
+
+    def _prefetch_shot_subfolders(self, batch):
+        # Get the subfolder names recorded for the shot folders of a batch whose attributes did not
+        # change since they were listed. The other shot folders are listed by _get_shot_subfolders,
+        # and their subfolders recorded by _save_shot_subfolders
+        paths = [path.path for path in (self._get_shot_path_info_by_tag(shot_tag) for shot_tag, shot in batch) if path]
+        recorded = self.shot_cache.get_subfolders(paths)
+        self.shot_subfolders = {}
+        self.shot_folder_attributes = {}
+        for path in paths:
+            entry = self.shot_folder_entries.get(path.rstrip('/'))
+            attributes = self._get_folder_attributes(entry) if entry is not None else None
+            if attributes is None:
+                continue
+            attributes = json.dumps(attributes)
+            if path in recorded and recorded[path][0] == attributes:
+                self.shot_subfolders[path] = recorded[path][1]
+            else:
+                self.shot_folder_attributes[path] = attributes
+        self.metrics.count('shot_folder_listings_skipped', len(self.shot_subfolders))
+
+    def _save_shot_subfolders(self):
+        # Record the subfolder names of the shot folders listed in the batch
+        if self.listed_subfolders:
+            self.shot_cache.set_subfolders(self.listed_subfolders)
+        self.listed_subfolders = []
+
+    def _skip_unchanged_shots(self, batch):
+        # Leave out of a batch the shots whose folder and versions did not change since their
+        # version tags were last committed
+        # The fingerprints of the other shots are recorded once their tags are committed
+        recorded = self.shot_cache.get_fingerprints(shot_tag.name for shot_tag, shot in batch)
+        changed = []
+        for shot_tag, shot in batch:
+            path = self._get_shot_path_info_by_tag(shot_tag)
+            entry = self.shot_folder_entries.get(path.path.rstrip('/')) if path else None
+            fingerprint = self._get_shot_fingerprint(path.path, entry, shot) if entry is not None else None
+            if fingerprint is not None and recorded.get(shot_tag.name) == fingerprint:
+                self.metrics.count('shot_folders_skipped')
+                continue
+            self.metrics.count('shot_folders_scanned')
+            if fingerprint is not None:
+                self.shot_fingerprints[shot_tag.name] = (path.path, fingerprint)
+            changed.append((shot_tag, shot))
+        return changed
+
+    def _save_shot_fingerprints(self, failures):
+        # Record the fingerprints of the scanned shots, except the ones with failed tag updates
+        failed_paths = set(os.path.dirname(path.rstrip('/')) for path, tags in failures)
+        self.shot_cache.set_fingerprints([(name, fingerprint) for name, (path, fingerprint) in self.shot_fingerprints.items()
+                                          if path.rstrip('/') not in failed_paths])
 
     def _handle_shot_status(self, shot_tag, shot):
         # Determine if a shot status implied tag needs to be updated
+        # Only the status implied tags are replaced, other implied tags are left untouched
         current_implied_tags = self._get_implied_tags_for_tag(self.SHOT_TAG_CAT, shot_tag.name)
-        new_implied_tag = '{0}/{1}'.format(self.SHOT_STATUS_CAT, shot['sg_status_list'])
+        new_implied_tag = self.shot_records.share('{0}/{1}'.format(self.SHOT_STATUS_CAT, shot.status))
+        stale_implied_tags = [implied_tag for implied_tag in current_implied_tags
+                              if implied_tag.startswith(self.SHOT_STATUS_CAT + '/') and implied_tag != new_implied_tag]
+        if stale_implied_tags:
+            self.implied_tags_to_delete.append(('{0}/{1}'.format(self.SHOT_TAG_CAT, shot_tag.name), stale_implied_tags))
         if new_implied_tag not in current_implied_tags:
             self.unique_tags_to_create.add(new_implied_tag)
-            self.implied_tag_updates.append(('{0}/{1}'.format(self.SHOT_TAG_CAT, shot_tag.name), [new_implied_tag]))
-            self.implied_tags_to_delete.append(('{0}/{1}'.format(self.SHOT_TAG_CAT, shot_tag.name), current_implied_tags))
+            self.implied_tag_updates.append(('{0}/{1}'.format(self.SHOT_TAG_CAT, shot_tag.name), new_implied_tag))
             # Update the expiration if needed
-            if shot['sg_status_list'] == self.shotgun_status_finalized and self.expiration_delay:
+            if shot.status == self.shotgun_status_finalized and self.expiration_delay:
                 expiration = datetime.datetime.now() + datetime.timedelta(days=int(self.expiration_delay))
                 shot_tag.expiration = time.mktime(expiration.timetuple())
                 self._update_tag(shot_tag)
-            elif shot['sg_status_list'] != self.shotgun_status_finalized:
+            elif shot.status != self.shotgun_status_finalized:
                 shot_tag.expiration = None
                 self._update_tag(shot_tag)
 
@@ -192,82 +739,847 @@ class ShotgunPlugin:
         # Enumerate all shots subfolders
         # If a matching shotgun version is found, the version folder is tagged
         # If no matching shotgun version is found, all tags are cleared
+        # The updates are queued by _queue_version_tag_updates once the whole batch is enumerated
         path = self._get_shot_path_info_by_tag(shot_tag)
-        if path:
-            for elem in self._get_folder_content(path.path):
-                if elem.fileType == 'FOLDER':
-                    version = self._find_shotgun_version_by_name(elem.name, shot['sg_versions'])
-                    if version:
-                        self.unique_tags_to_create.add('{0}/{1}'.format(self.SHOT_VERSION_CAT, elem.name))
-                        self.tag_updates.append((os.path.join(path.path, elem.name), ['{0}/{1}'.format(self.SHOT_VERSION_CAT, elem.name)]))
-                    else:
-                        self.tag_updates.append((os.path.join(path.path, elem.name), []))
+        subfolders = self._get_shot_subfolders(path.path) if path else None
+        if subfolders is None and isinstance(path, CachedPath):
+            # The shot folder moved since its path was cached
+            self._invalidate_shot_path(shot_tag)
+            path = self._get_shot_path_info_by_tag(shot_tag)
+            subfolders = self._get_shot_subfolders(path.path) if path else None
+        if subfolders:
+            versions = self._index_shotgun_versions(shot)
+            for name in subfolders:
+                version = self._find_shotgun_version_by_name(name, versions)
+                self.version_folder_candidates.append((os.path.join(path.path, name), name, version is not None))
+
+    def _queue_version_tag_updates(self):
+        # Queue the tag updates of the version folders enumerated in the batch
+        # Folders matching a version get its version tag, the other folders are cleared
+        # With the shot cache, the version tag last committed on each folder is recorded, and the
+        # folders already carrying the right tag, or already cleared, are skipped. Folders without a
+        # record, such as renamed folders, are always written
+        recorded = {}
+        if self.shot_cache is not None:
+            recorded = self.shot_cache.get_folder_tags(path for path, name, matched in self.version_folder_candidates)
+        for path, name, matched in self.version_folder_candidates:
+            tag = '{0}/{1}'.format(self.SHOT_VERSION_CAT, name) if matched else None
+            if recorded.get(path) == (tag or ''):
+                self.metrics.count('version_folders_unchanged')
+                continue
+            if tag:
+                self.unique_tags_to_create.add(tag)
+            self.tag_updates.append((path, tag))
+        self.version_folder_candidates = []
 
     def _create_new_tags(self):
-        # Create all tags in CN
-        for implied_tag in self.unique_tags_to_create:
-            splitted_tag = implied_tag.split('/')
-            self._get_or_create_category(splitted_tag[0])
-            self._get_or_create_tag(splitted_tag[0], splitted_tag[1])
+        # Create the tags missing in CN
+        # The existing tags of each category are loaded once in the tag catalog
+        for implied_tag in sorted(self.unique_tags_to_create):
+            category_name, tag_name = implied_tag.split('/', 1)
+            try:
+                category = self._get_catalog_category(category_name)
+                if category is None:
+                    self._get_or_create_category(category_name)
+                    category = self.tag_catalog[category_name] = {}
+                if tag_name not in category:
+                    category[tag_name] = self._get_or_create_tag(category_name, tag_name)['id']
+                    self.metrics.count('tags_created')
+            except:
+                self.log.error(self._format_log(('Failed to create tag', implied_tag)))
 
-    def _commit_tags(self):
-        # Commit all tags
+    def _commit_bisecting(self, commit, updates, failures):
+        # Commit a batch of updates, splitting a failed batch in two halves until the failing
+        # updates are isolated, so k failing updates out of n cost O(k log n) calls
         try:
-            self.api.bulkSetTagsForFolder(updates=self.tag_updates)
+            commit(updates)
         except:
-            self.log.error(self._format_log(('Failed to bulk set tags', 'Attempting to set one by one')))
-            for tag in self.tag_updates:
-                try:
-                    self.api.bulkSetTagsForFolder(updates=[tag])
-                except:
-                    self.log.error(self._format_log(('Failed to set tag', tag[0], tag[1])))
+            if len(updates) == 1:
+                failures.append(updates[0])
+                return
+            middle = len(updates) // 2
+            self._commit_bisecting(commit, updates[:middle], failures)
+            self._commit_bisecting(commit, updates[middle:], failures)
+
+    def _commit_in_batches(self, commit, updates):
+        # Commit updates in batches of at most commitBatchSize updates
+        # Returns the updates which could not be committed
+        failures = []
+        for batch in chunks(updates, self.commit_batch_size):
+            self._commit_bisecting(commit, batch, failures)
+        return failures
+
+    def _commit_tags(self):
+        # Commit all tags
+        # Updates are queued as (path, tag or None), the tag lists are only built for the committed batch
+        # Returns the updates which could not be committed
+        def commit(updates):
+            self.api.bulkSetTagsForFolder(updates=[(path, [tag] if tag else []) for path, tag in updates])
+        self.metrics.count('tag_updates', len(self.tag_updates))
+        failures = self._commit_in_batches(commit, self.tag_updates)
+        self.metrics.count('tag_update_failures', len(failures))
+        if failures:
+            self.log.error(self._format_log(('Failed to set tags on %d folders' % len(failures),
+                                             '; '.join('{0} [{1}]'.format(path, tag or '') for path, tag in failures))))
+        return failures
+
+    def _save_folder_tags(self, failures):
+        # Record the version tags committed on the version folders, except the failed updates
+        failed_paths = set(path for path, tag in failures)
+        self.shot_cache.set_folder_tags([(path, tag or '') for path, tag in self.tag_updates if path not in failed_paths])
 
     def _commit_implied_tags(self):
         # Commit all implied tags
+        # Deletions come first so that they are committed before the additions when a batch is split
+        # Additions are queued as (parent tag, implied tag), deletions as (parent tag, implied tags)
+        def commit(updates):
+            self.api.bulkImpliedTagUpdate(tagsToAdd=[(parent, [tag]) for operation, (parent, tag) in updates if operation == 'add'],
+                                          tagsToDelete=[update for operation, update in updates if operation == 'delete'])
+        updates = [('delete', update) for update in self.implied_tags_to_delete] + [('add', update) for update in self.implied_tag_updates]
+        self.metrics.count('implied_tag_deletions', len(self.implied_tags_to_delete))
+        self.metrics.count('implied_tag_additions', len(self.implied_tag_updates))
+        failures = self._commit_in_batches(commit, updates)
+        self.metrics.count('implied_tag_update_failures', len(failures))
+        if failures:
+            self.log.error(self._format_log(('Failed to update implied tags of %d tags' % len(failures),
+                                             '; '.join('{0} {1} [{2}]'.format(operation, parent, tags if operation == 'add' else '-'.join(tags))
+                                                       for operation, (parent, tags) in failures))))
+
+    def _write_metrics(self, status):
+        # Write the run summary and Prometheus textfile to the working directory
+        self.metrics.finish(status)
         try:
-            self.api.bulkImpliedTagUpdate(tagsToAdd=self.implied_tag_updates, tagsToDelete=self.implied_tags_to_delete)
-        except:
-            self.log.error(self._format_log(('Failed to bulk update implied tags', 'Attempting to update one by one')))
-            for implied_tag in self.implied_tag_updates:
+            summary = self.metrics.write(self.working_dir)
+        except (IOError, OSError):
+            self.log.error(self._format_log(('Failed to write the run metrics', self.working_dir)))
+            return
+        self.log.info(self._format_log(['Run %s in %.1fs' % (status, summary['duration'])] +
+                                       ['%s %.1fs' % (name, elapsed) for name, elapsed in sorted(summary['phases'].items())]))
+
+    def _process_batch(self, batch):
+        # Queue the ClarityNow updates of a batch of matched shot tags
+        self.metrics.count('matched_shots', len(batch))
+        batch_tags = [shot_tag for shot_tag, match in batch]
+        with self.metrics.phase('status'):
+            self._prefetch_implied_tags(batch_tags)
+            for shot_tag, match in batch:
+                self._handle_shot_status(shot_tag, match)
+        with self.metrics.phase('versions'):
+            self._prefetch_shot_paths(batch_tags)
+            if self.skip_unchanged_shots or self.version_discovery == 'sequence':
+                self._prefetch_shot_folder_entries(batch)
+            if self.skip_unchanged_shots:
+                batch = self._skip_unchanged_shots(batch)
+            if self.version_discovery == 'sequence':
+                self._prefetch_shot_subfolders(batch)
+            for shot_tag, match in batch:
+                self._handle_shot_versions(shot_tag, match)
+            if self.version_discovery == 'sequence':
+                self._save_shot_subfolders()
+            self._queue_version_tag_updates()
+
+    def _create_batch_worker(self):
+        # Copy of the plugin handling batches over its own ClarityNow connection, as the
+        # ClarityNow client is not thread-safe
+        # The tag catalog and the shot paths resolved during the run are shared, they are only
+        # read while the batches are handled
+        worker = copy.copy(self)
+        worker.api = self._connect_claritynow()
+        worker._reset_run()
+        worker.tag_catalog = self.tag_catalog
+        worker.resolved_shot_paths = self.resolved_shot_paths
+        return worker
+
+    def _merge_batch_worker(self, worker):
+        # Collect the updates queued by a batch worker
+        self.unique_tags_to_create.update(worker.unique_tags_to_create)
+        self.implied_tag_updates.extend(worker.implied_tag_updates)
+        self.implied_tags_to_delete.extend(worker.implied_tags_to_delete)
+        self.tag_updates.extend(worker.tag_updates)
+        self.shot_fingerprints.update(worker.shot_fingerprints)
+
+    def _process_batches_concurrently(self, batches):
+        # Hand the batches over to claritynowConcurrency workers
+        # Batches are produced while the workers run, so that fetching and matching the shotgun
+        # shots overlaps the ClarityNow requests of the previous batches
+        # At most claritynowConcurrency batches wait for a worker at any time
+        self._get_catalog_category(self.SHOT_VERSION_CAT)
+        workers = [self._create_batch_worker() for i in range(self.claritynow_concurrency)]
+        pending = Queue.Queue(maxsize=self.claritynow_concurrency)
+        errors = []
+
+        def handle_batches(worker):
+            while True:
+                batch = pending.get()
+                if batch is None:
+                    return
+                if errors:
+                    # Drop the remaining batches once a worker failed
+                    continue
                 try:
-                    self.api.bulkImpliedTagUpdate(tagsToAdd=[implied_tag])
-                except:
-                    self.log.error(self._format_log(('Failed to add implied tags', '-'.join(implied_tag[1]), 'parent {0}'.format(implied_tag[0]))))
-            for implied_tag in self.implied_tags_to_delete:
+                    worker._process_batch(batch)
+                except Exception as e:
+                    self.log.error(self._format_log(('Failed to handle a batch of shots', traceback.format_exc())))
+                    errors.append(e)
+
+        threads = [threading.Thread(target=handle_batches, args=(worker,)) for worker in workers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for batch in batches:
+                if errors:
+                    break
+                pending.put(batch)
+        finally:
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        for worker in workers:
+            self._merge_batch_worker(worker)
+
+    def _queue_matches(self, matches):
+        # Queue the ClarityNow updates of the matched shot tags
+        batches = self.metrics.timed(chunks(matches, self.claritynow_batch_size), 'matching')
+        if self.claritynow_concurrency > 1:
+            self._process_batches_concurrently(batches)
+        else:
+            for batch in batches:
+                self._process_batch(batch)
+
+    def _process_matches(self, matches):
+        # Update the ClarityNow tags of the matched shot tags
+        self._queue_matches(matches)
+        with self.metrics.phase('tag_creation'):
+            self._create_new_tags()
+        self._commit_updates()
+
+    def _commit_updates(self):
+        # Commit the queued updates, once the tags they refer to exist
+        with self.metrics.phase('commit_tags'):
+            failures = self._commit_tags()
+            if self.shot_cache is not None:
+                self._save_folder_tags(failures)
+            if self.skip_unchanged_shots:
+                self._save_shot_fingerprints(failures)
+        with self.metrics.phase('commit_implied_tags'):
+            self._commit_implied_tags()
+
+    def _sync(self):
+        # Sweep all the shot tags, or the ones of the shots updated since the last run
+        state = self._load_state()
+        full_sync = self._is_full_sync_due(state)
+        self.metrics.mode = 'full' if full_sync else 'incremental'
+        with self.metrics.phase('shot_tags'):
+            shot_tags = self._retrieve_shot_tags()
+        self.metrics.count('shot_tags', len(shot_tags))
+        # The shot tags just retrieved seed the tag catalog
+        self.tag_catalog = {self.SHOT_TAG_CAT: dict((shot_tag.name, shot_tag.id) for shot_tag in shot_tags)}
+        if full_sync:
+            self.log.info(self._format_log(('Shotgun plugin', 'Full sync')))
+            updated_since = None
+            if self.shot_cache is not None:
+                # Every shot tag is resolved again, the misses of the full sync replace the previous ones
+                self.shot_cache.clear_shot_tag_misses()
+        else:
+            self.log.info(self._format_log(('Shotgun plugin', 'Incremental sync of shots updated since %s' % datetime.datetime.fromtimestamp(state['watermark']))))
+            updated_since = state['watermark']
+        if self.shard_processes > 1:
+            self._process_shards(shot_tags, full_sync, updated_since)
+        else:
+            self._process_matches(self._fetch_matches(shot_tags, full_sync, updated_since))
+        self.sg.close()
+        # Only move the watermark forward once the run succeeded
+        values = {}
+        if self.last_updated_at is not None and self.last_updated_at > (state.get('watermark') or 0):
+            values['watermark'] = self.last_updated_at
+        if full_sync:
+            values['last_full_sync'] = time.time()
+        self._update_state(**values)
+
+    def _fetch_matches(self, shot_tags, full_sync, updated_since):
+        # Fetch the shotgun shots of the shot tags and pair them with the shot tags
+        # With the shot cache, the shot tags which did not follow the shot tag rule or matched no
+        # shot during the last full sync are recorded. The incremental syncs leave them out of the
+        # matching and only look them up by the name of the fetched shots, so that a shot created or
+        # renamed after its folder is still matched. They still scope the Shot query
+        misses = {}
+        if self.shot_cache is not None and not full_sync:
+            shot_tags, misses = self._skip_shot_tag_misses(shot_tags)
+        with self.metrics.phase('shotgun_fetch'):
+            shots = self._retrieve_shotgun_shots(shot_tags + list(misses.values()), updated_since=updated_since)
+        if self.streaming_fetch:
+            # Streamed shots are fetched while they are matched
+            shots = self.metrics.timed(shots, 'shotgun_fetch')
+        found = []
+        if misses:
+            shots = self._find_shot_tag_misses(shots, misses, found)
+        # During an incremental sync, only the shots updated since the last run are known
+        matches = self._match_shot_tags(shot_tags, shots, report_unmatched=full_sync,
+                                        record_misses=(full_sync and self.shot_cache is not None))
+        # The skipped shot tags found are paired once every shot went through the matching
+        return itertools.chain(matches, self._forget_shot_tag_misses(found))
+
+    def _skip_shot_tag_misses(self, shot_tags):
+        # Leave out the shot tags recorded as not following the shot tag rule or matching no shot
+        # A shot tag recreated since, with another id, is kept
+        # Returns the kept shot tags, and the left out ones as a name to shot tag map
+        misses = self.shot_cache.get_shot_tag_misses(self.shot_names.key)
+        kept = []
+        skipped = {}
+        for shot_tag in shot_tags:
+            if misses.get(shot_tag.name) == shot_tag.id:
+                skipped[shot_tag.name] = shot_tag
+            else:
+                kept.append(shot_tag)
+        self.metrics.count('shot_tag_misses_skipped', len(skipped))
+        return kept, skipped
+
+    def _find_shot_tag_misses(self, shots, misses, found):
+        # Pass the shots through, adding to found the skipped shot tags named after one of them
+        for shot in shots:
+            shot_tag = misses.pop(self.shot_names.format(shot.key()), None)
+            if shot_tag is not None:
+                found.append((shot_tag, shot))
+            yield shot
+
+    def _forget_shot_tag_misses(self, found):
+        # Pair the skipped shot tags found in the fetched shots, they are no longer misses
+        if found:
+            self.metrics.count('shot_tag_misses_matched', len(found))
+            self.shot_cache.delete_shot_tag_misses(self.shot_names.key, [shot_tag.name for shot_tag, shot in found])
+        for match in found:
+            yield match
+
+    def _get_shot_tag_shards(self, shot_tags):
+        # Split the shot tags in at most shardProcesses shards of about the same size
+        # Shot tags are grouped by the project of their first candidate key, so that each shard
+        # only fetches the shotgun shots of its own projects
+        # Groups of more than shardMaxShotTags shot tags are split by a hash of the shot tag name
+        max_shot_tags = self.shard_max_shot_tags or -(-len(shot_tags) // self.shard_processes)
+        groups = {}
+        for shot_tag in shot_tags:
+            groups.setdefault(self.shot_names.project(shot_tag.name), []).append(shot_tag)
+        parts = []
+        for name in sorted(groups):
+            group = groups[name]
+            count = -(-len(group) // max_shot_tags)
+            if count <= 1:
+                parts.append(group)
+                continue
+            split = [[] for i in range(count)]
+            for shot_tag in group:
+                split[int(hashlib.sha1(shot_tag.name.encode('utf8')).hexdigest(), 16) % count].append(shot_tag)
+            parts.extend(split)
+        # The largest parts go first, each to the smallest shard so far
+        shards = [[] for i in range(self.shard_processes)]
+        for part in sorted(parts, key=len, reverse=True):
+            min(shards, key=len).extend(part)
+        return [shard for shard in shards if shard]
+
+    def _run_shard(self, shot_tags, full_sync, updated_since, shard_count, connection):
+        # Worker process: fetch, match and queue the updates of a shard over its own connections
+        # The tags to create are sent to the parent process, which creates the tags of all the shards,
+        # and the updates are committed once the parent process answers "commit"
+        # Messages are ('tags', tags), ('done', metrics summary, last updated_at) and ('failed', error)
+        # The API limits are shared evenly by the shards
+        try:
+            self.metrics = RunMetrics()
+            self.api_limits = dict((backend, bucket.split(shard_count)) for backend, bucket in self.api_limits.items())
+            self.api = self._connect_claritynow()
+            self.sg = self._connect_shotgun()
+            if self.shot_cache is not None:
+                # A sqlite connection cannot be shared with the parent process
+                self.shot_cache = ShotCache(os.path.join(self.working_dir, CACHE_FILE))
+            self._queue_matches(self._fetch_matches(shot_tags, full_sync, updated_since))
+            self.sg.close()
+            connection.send(('tags', self.unique_tags_to_create))
+            if connection.recv() == 'commit':
+                self._commit_updates()
+            connection.send(('done', self.metrics.summary(), self.last_updated_at))
+        except Exception:
+            self.log.error(self._format_log(('Failed to handle a shard of %d shots' % len(shot_tags), traceback.format_exc())))
+            try:
+                connection.send(('failed', traceback.format_exc()))
+            except (EOFError, IOError):
+                pass
+        finally:
+            connection.close()
+
+    def _receive_from_shard(self, connection):
+        try:
+            return connection.recv()
+        except (EOFError, IOError):
+            return ('failed', 'Shard worker process exited unexpectedly')
+
+    def _process_shards(self, shot_tags, full_sync, updated_since):
+        # Hand the shot tags over to shardProcesses worker processes, one shard each
+        # The tags missing in ClarityNow are created by this process for all the shards, before
+        # the workers commit their updates. No update is committed if a worker failed before
+        # The version tags are loaded once, before the workers are forked
+        self._get_catalog_category(self.SHOT_VERSION_CAT)
+        shards = self._get_shot_tag_shards(shot_tags)
+        self.metrics.count('shards', len(shards))
+        workers = []
+        errors = []
+        try:
+            for shard in shards:
+                connection, worker_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=self._run_shard, args=(shard, full_sync, updated_since, len(shards), worker_connection))
+                process.daemon = True
+                process.start()
+                worker_connection.close()
+                workers.append((process, connection))
+            running = []
+            for process, connection in workers:
+                message = self._receive_from_shard(connection)
+                if message[0] == 'tags':
+                    self.unique_tags_to_create.update(message[1])
+                    running.append(connection)
+                else:
+                    errors.append(message[1])
+            if not errors:
+                with self.metrics.phase('tag_creation'):
+                    self._create_new_tags()
+            for connection in running:
+                connection.send('abort' if errors else 'commit')
+            for connection in running:
+                message = self._receive_from_shard(connection)
+                if message[0] != 'done':
+                    errors.append(message[1])
+                    continue
+                self.metrics.merge(message[1])
+                if message[2] is not None and (self.last_updated_at is None or message[2] > self.last_updated_at):
+                    self.last_updated_at = message[2]
+        finally:
+            for process, connection in workers:
+                connection.close()
+                process.join()
+        if errors:
+            raise RuntimeError('%d of %d shards failed:\n%s' % (len(errors), len(shards), '\n'.join(errors)))
+
+    def _get_shot_tags_for_shots(self, shots):
+        # Get the shot tags named after the given shotgun shots
+        # Shots without a shot tag have no folder on the filesystem and are skipped
+        shot_tags = []
+        for shot in shots:
+            name = self.shot_names.format(shot.key())
+            try:
+                shot_tags.append(self.api.getTag(self.SHOT_TAG_CAT, name))
+            except:
+                self.log.debug(self._format_log(('No shot tag for shotgun shot %s' % name, 'Skipping shot.')))
+        return shot_tags
+
+    def _sync_shots(self, shot_ids, version_ids=()):
+        # Update the shot tags of the given shotgun shots, and of the shots of the given versions, only
+        self.metrics.mode = 'shots'
+        shots = []
+        with self.metrics.phase('shotgun_fetch'):
+            shot_ids = set(shot_ids) | self._get_version_shot_ids(version_ids)
+            for ids in chunks(sorted(shot_ids), self.shotgun_filter_chunk_size):
+                shots.extend(self._compact_shots(self.sg.find('Shot', [['id', 'in', ids]], self.SHOT_FIELDS)))
+        with self.metrics.phase('shot_tags'):
+            shot_tags = self._get_shot_tags_for_shots(shots)
+        self.metrics.count('shot_tags', len(shot_tags))
+        self._process_matches(self._match_shot_tags(shot_tags, shots, report_unmatched=False))
+
+    def _get_selection_scope(self, path):
+        # Shot tag name prefix of the shot folders at or below a selected path, and the selected path
+        # truncated to the shot folder level
+        # Shot folders follow the /volume/show/sequences/sequence/shots/shot layout of the autotag rule
+        # Returns None when no shot folder can be at or below the path
+        parts = [part for part in path.split('/') if part][:6]
+        if (len(parts) > 2 and parts[2] != 'sequences') or (len(parts) > 4 and parts[4] != 'shots'):
+            return None
+        names = parts[1:6:2]
+        return (self.shot_names.prefix(names) if names else ''), '/' + '/'.join(parts)
+
+    def _get_selected_shot_tags(self, paths):
+        # Find the shot tags applied at or below the selected paths
+        # Candidate shot tags are the ones named after the selected shows, sequences or shots,
+        # they are kept if their shot folder is actually at or below a selected path
+        # The shot tags of up to MAX_SHOT_TAG_LOOKUPS selected shot folders are looked up by name,
+        # other selections go through the whole shot tag list
+        # Returns the shot tags and the keys of their shots
+        prefixes = set()
+        scopes = set()
+        for path in paths:
+            scope = self._get_selection_scope(path)
+            if scope is None:
+                self.log.info(self._format_log(('Selected path %s' % path, 'No shot folder below, skipping path.')))
+                continue
+            prefixes.add(scope[0])
+            scopes.add(scope[1])
+        # Drop the prefixes covered by a shorter one, the closest lower prefix of a name is then
+        # the only one it may start with
+        sorted_prefixes = []
+        for prefix in sorted(prefixes):
+            if not sorted_prefixes or not prefix.startswith(sorted_prefixes[-1]):
+                sorted_prefixes.append(prefix)
+        candidates = []
+        if scopes and len(scopes) <= MAX_SHOT_TAG_LOOKUPS and all(scope.count('/') == 6 for scope in scopes):
+            # Only shot folders are selected, their shot tags are looked up by name
+            for name in sorted(prefixes):
                 try:
-                    self.api.bulkImpliedTagUpdate(tagsToAdd=[implied_tag])
+                    candidates.append(self.api.getTag(self.SHOT_TAG_CAT, name))
                 except:
-                    self.log.error(self._format_log(('Failed to delete implied tags', '-'.join(implied_tag[1]), 'parent {0}'.format(implied_tag[0]))))
+                    self.log.debug(self._format_log(('No shot tag %s' % name, 'Skipping shot.')))
+        elif sorted_prefixes:
+            for shot_tag in self._retrieve_shot_tags():
+                i = bisect.bisect_right(sorted_prefixes, shot_tag.name)
+                if i and shot_tag.name.startswith(sorted_prefixes[i - 1]):
+                    candidates.append(shot_tag)
+        shot_tags = []
+        keys = []
+        for batch in chunks(candidates, self.claritynow_batch_size):
+            self._prefetch_shot_paths(batch)
+            for shot_tag in batch:
+                path = self._get_shot_path_info_by_tag(shot_tag)
+                if not path:
+                    continue
+                # Kept for the batches of the run, so that the path is not resolved again
+                self.resolved_shot_paths[shot_tag.name] = path
+                parts = [part for part in path.path.split('/') if part]
+                if not any('/' + '/'.join(parts[:i]) in scopes for i in range(1, len(parts) + 1)) and '/' not in scopes:
+                    continue
+                shot_tags.append(shot_tag)
+                if len(parts) >= 6:
+                    keys.append((parts[1], parts[3], parts[5]))
+        return shot_tags, keys
+
+    def _retrieve_selected_shotgun_shots(self, shot_tags, keys):
+        # Fetch the shotgun shots of the selected shot folders
+        # Up to shotgunFilterChunkSize shots are fetched by code, larger selections are fetched as a sweep
+        if len(keys) > self.shotgun_filter_chunk_size or len(keys) < len(shot_tags):
+            return list(self._retrieve_shotgun_shots(shot_tags))
+        scopes = {}
+        for project, sequence, code in keys:
+            scope = scopes.setdefault(project, (set(), set()))
+            scope[0].add(sequence)
+            scope[1].add(code)
+        shots = []
+        for project in sorted(scopes):
+            sequences, codes = scopes[project]
+            filters = [['project.Project.name', 'is', project],
+                       ['sg_sequence.Sequence.code', 'in', sorted(sequences)],
+                       ['code', 'in', sorted(codes)]]
+            shots.extend(self._compact_shots(self.sg.find('Shot', filters, self.SHOT_FIELDS)))
+        return shots
+
+    def _sync_selection(self, paths):
+        # Update the shot tags applied at or below the selected paths only
+        self.metrics.mode = 'selection'
+        with self.metrics.phase('shot_tags'):
+            shot_tags, keys = self._get_selected_shot_tags(paths)
+        self.metrics.count('shot_tags', len(shot_tags))
+        with self.metrics.phase('shotgun_fetch'):
+            shots = self._retrieve_selected_shotgun_shots(shot_tags, keys)
+        self._process_matches(self._match_shot_tags(shot_tags, shots))
+
+    def _run(self, sync, *args):
+        # Run a sync, recording its metrics
+        self.metrics.reset()
+        self._reset_run()
+        try:
+            sync(*args)
+        except:
+            self._write_metrics('failed')
+            raise
+        self._write_metrics('success')
 
     def start(self):
         self.log.info(self._format_log(('Shotgun plugin', 'Starting execution')))
-        shot_tags = self._retrieve_shot_tags()
-        shots = self._retrieve_shotgun_shots()
-        for shot_tag in shot_tags:
-            match = self._find_shotgun_shot_by_unique_name(shot_tag.name, shots)
-            if match is None:
-                self.log.warning(('Unable to find matching shotgun shot for %s' % shot_tag.name, 'Skipping shot.'))
-                continue
-            self._handle_shot_status(shot_tag, match)
-            self._handle_shot_versions(shot_tag, match)
-        self._create_new_tags()
-        self._commit_tags()
-        self._commit_implied_tags()
-        self.sg.close()
+        self._run(self._sync)
+        self.log.info(self._format_log(('Shotgun plugin', 'Execution terminated')))
+
+    def update_shots(self, shot_ids, version_ids=()):
+        self.log.info(self._format_log(('Shotgun plugin', 'Updating %d shots and %d versions' % (len(shot_ids), len(version_ids)))))
+        self._run(self._sync_shots, shot_ids, version_ids)
         self.log.info(self._format_log(('Shotgun plugin', 'Execution terminated')))
 
+    def update_selection(self, paths):
+        self.log.info(self._format_log(('Shotgun plugin', 'Updating the shots of %d selected paths' % len(paths))))
+        self._run(self._sync_selection, paths)
+        self.log.info(self._format_log(('Shotgun plugin', 'Execution terminated')))
+
+    def _run_request(self, request):
+        if request.get('rebuild_cache'):
+            self.clear_cache()
+        if request.get('sweep'):
+            self.start()
+            return
+        if request.get('shot_ids') or request.get('version_ids'):
+            self.update_shots(request.get('shot_ids', []), request.get('version_ids', []))
+        if request.get('paths'):
+            self.update_selection(request['paths'])
+
+    def run_request(self, request):
+        # Run a request, see run_lock.merge_requests, unless another process is running the plugin
+        # The request then attaches to the current run if it is the same request, otherwise it is
+        # left pending and the process running the plugin runs it next, merged with the other
+        # pending requests
+        lock = RunLock(self.working_dir, self.stale_lock_timeout)
+        outcome = lock.acquire(request)
+        if lock.stale_holder is not None:
+            self.log.warning(self._format_log(('Shotgun plugin', 'Replacing the stale lock of process %s on %s' % (lock.stale_holder.get('pid'), lock.stale_holder.get('host')))))
+        if outcome != 'acquired':
+            holder = 'process %s on %s since %s' % (lock.holder.get('pid'), lock.holder.get('host'), datetime.datetime.fromtimestamp(lock.holder.get('started') or 0))
+            if outcome == 'attached':
+                self.log.info(self._format_log(('Shotgun plugin', 'Same run in progress by %s' % holder, 'Waiting for it to complete')))
+                lock.wait()
+            else:
+                self.log.info(self._format_log(('Shotgun plugin', 'Run in progress by %s' % holder, 'Request queued for the next run')))
+            return
+        try:
+            while request is not None:
+                self._run_request(request)
+                request = lock.take_pending()
+        finally:
+            lock.release()
+
+    def _get_version_shot_ids(self, version_ids):
+        # Get the ids of the shotgun shots the given versions are linked to
+        shot_ids = set()
+        for ids in chunks(sorted(version_ids), self.shotgun_filter_chunk_size):
+            for version in self.sg.find('Version', [['id', 'in', ids]], ['entity']):
+                if version.get('entity') and version['entity']['type'] == 'Shot':
+                    shot_ids.add(version['entity']['id'])
+        return shot_ids
+
+    def _get_event_entity_ids(self, events):
+        # Get the ids of the shotgun shots and versions of the events
+        shot_ids = set()
+        version_ids = set()
+        for event in events:
+            entity = event.get('entity')
+            if not entity:
+                continue
+            if entity['type'] == 'Shot':
+                shot_ids.add(entity['id'])
+            elif entity['type'] == 'Version':
+                version_ids.add(entity['id'])
+        return shot_ids, version_ids
+
+    def _poll_events(self, last_event_id):
+        # Get the shot and version events logged after last_event_id, oldest first
+        filters = [['id', 'greater_than', last_event_id], ['event_type', 'in', self.SHOT_EVENT_TYPES]]
+        return self.sg.find('EventLogEntry', filters, ['event_type', 'entity', 'attribute_name'],
+                            order=[{'field_name': 'id', 'direction': 'asc'}], limit=self.shotgun_page_size)
+
+    def _get_latest_event_id(self):
+        events = self.sg.find('EventLogEntry', [], [], order=[{'field_name': 'id', 'direction': 'desc'}], limit=1)
+        return events[0]['id'] if events else 0
+
+    def run_daemon(self):
+        # Keep updating the shots changed in shotgun, as logged in the EventLogEntry stream
+        # Events are collected for eventBatchWindow seconds once a first one is received, so that
+        # bursts of changes are handled together
+        # The id of the last handled event is persisted, the daemon resumes from it after a restart
+        self.log.info(self._format_log(('Shotgun plugin', 'Starting daemon')))
+        last_event_id = self._load_state().get('last_event_id')
+        if last_event_id is None:
+            # Events logged before the daemon first started are covered by the sweep
+            last_event_id = self._get_latest_event_id()
+            self._update_state(last_event_id=last_event_id)
+        while True:
+            try:
+                events = self._poll_events(last_event_id)
+                if not events:
+                    time.sleep(self.event_poll_interval)
+                    continue
+                window_end = time.time() + self.event_batch_window
+                while time.time() < window_end:
+                    time.sleep(max(0, min(self.event_poll_interval, window_end - time.time())))
+                    events.extend(self._poll_events(events[-1]['id']))
+                shot_ids, version_ids = self._get_event_entity_ids(events)
+                self.log.info(self._format_log(('Shotgun plugin', '%d events' % len(events), 'Updating %d shots and %d versions' % (len(shot_ids), len(version_ids)))))
+                request = {}
+                if shot_ids:
+                    request['shot_ids'] = sorted(shot_ids)
+                if version_ids:
+                    request['version_ids'] = sorted(version_ids)
+                if request:
+                    self.run_request(request)
+                last_event_id = events[-1]['id']
+                self._update_state(last_event_id=last_event_id)
+            except Exception:
+                self.log.error(self._format_log(('Shotgun plugin', 'Failed to handle shotgun events', traceback.format_exc())))
+                time.sleep(self.event_poll_interval)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog=NAME, description='Apply shotgun shot status and version tags to the shot folders.')
+    parser.add_argument('path_file', nargs='?',
+                        help='file listing the paths selected when the action is run manually, only the shots at or below them are updated')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and update the shots as they change in shotgun, from the EventLogEntry stream')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep running and handle the runs requested by cn_shotgun_client.py over a unix socket')
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help='clear the shot folders cached with shotPathCache and skipUnchangedShots before the run')
+    parser.add_argument('--shot-ids', type=parse_ids, default=[], metavar='ID[,ID...]',
+                        help='only update the given shotgun shots')
+    parser.add_argument('--version-ids', type=parse_ids, default=[], metavar='ID[,ID...]',
+                        help='only update the shots of the given shotgun versions')
+    return parser.parse_args(argv)
+
+def run(shotgun, args):
+    request = {}
+    if args.rebuild_cache:
+        request['rebuild_cache'] = True
+    if args.path_file:
+        request['paths'] = ccmtools.getPaths(args.path_file, version=NAME)
+    elif args.shot_ids or args.version_ids:
+        if args.shot_ids:
+            request['shot_ids'] = sorted(set(args.shot_ids))
+        if args.version_ids:
+            request['version_ids'] = sorted(set(args.version_ids))
+    else:
+        request['sweep'] = True
+    shotgun.run_request(request)
+
+def get_config_mtime():
+    # Modification time of the plugin configuration, None if unknown
+    if PLATFORM_MODE != 'dataiq':
+        return None
+    from plugin_configs import CfgReader
+    try:
+        return os.path.getmtime(CfgReader(LOGGING_NAME).config_path)
+    except OSError:
+        return None
+
+def read_line(connection):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode('utf8')
+
+def send_line(connection, message):
+    connection.sendall((json.dumps(message) + '\n').encode('utf8'))
+
+class ClientLogHandler(logging.Handler):
+    # Forward the log records of a run to the client which requested it, so that they show in the
+    # output of the action or cron job. Records are dropped once the client disconnected
+    def __init__(self, connection):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.connection = connection
+
+    def emit(self, record):
+        if self.connection is None:
+            return
+        try:
+            send_line(self.connection, {'log': self.format(record)})
+        except socket.error:
+            self.connection = None
+
+def accept_requests(server, connections, busy):
+    # Accept the clients of the resident worker, handing them over to the worker one at a time
+    # Each client is first told whether the worker is busy. A client connecting while a run is in
+    # progress runs the plugin in its own process instead, so that its request goes through the run
+    # lock and attaches to the current run or is queued for the next one
+    while True:
+        connection = server.accept()[0]
+        try:
+            if busy.is_set():
+                send_line(connection, {'busy': True})
+                connection.close()
+                continue
+            send_line(connection, {'busy': False})
+        except socket.error:
+            connection.close()
+            continue
+        busy.set()
+        connections.put(connection)
+
+def is_stale_connection_failure(shotgun):
+    # Whether a failed run did no work: every API call it made failed, as when a connection kept by
+    # the worker expired while it was idle
+    calls = shotgun.metrics.summary()['calls']
+    return bool(calls) and all(call['errors'] == call['count'] for call in calls)
+
+def serve(scriptFilePath):
+    # Resident worker: handle the runs requested over a unix socket, one at a time
+    # The plugin, with its configuration and connections, is kept between runs. It is built again
+    # when the configuration changed. A run over a kept plugin whose API calls all failed is retried
+    # once with a new one, in case a connection expired while the worker was idle
+    # Requests are single JSON lines: {"args": [...]}, sent once the worker answered {"busy": false}.
+    # The log records of the run are sent back as {"log": ...} lines, followed by
+    # {"status": ..., "error": ..., "traceback": ...}
+    socket_path = os.path.join(get_working_dir(scriptFilePath), SOCKET_FILE)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(5)
+    connections = Queue.Queue()
+    busy = threading.Event()
+    acceptor = threading.Thread(target=accept_requests, args=(server, connections, busy), name='cn-shotgun-accept')
+    acceptor.daemon = True
+    acceptor.start()
+    shotgun = None
+    shotgun_config_mtime = None
+    while True:
+        connection = connections.get()
+        handler = ClientLogHandler(connection)
+        logging.getLogger().addHandler(handler)
+        try:
+            response = {'status': 'success'}
+            try:
+                args = parse_args(json.loads(read_line(connection))['args'])
+                if args.daemon or args.serve:
+                    raise ValueError('--daemon and --serve cannot be requested from the resident worker')
+                config_mtime = get_config_mtime()
+                if shotgun is not None and config_mtime == shotgun_config_mtime:
+                    try:
+                        run(shotgun, args)
+                    except Exception:
+                        if not is_stale_connection_failure(shotgun):
+                            raise
+                        shotgun.log.warning(shotgun._format_log(('Shotgun plugin', 'Run failed over the kept connections, reconnecting and retrying once',
+                                                                 traceback.format_exc())))
+                        shotgun = None
+                        shotgun = ShotgunPlugin(scriptFilePath)
+                        run(shotgun, args)
+                else:
+                    shotgun = None
+                    shotgun = ShotgunPlugin(scriptFilePath)
+                    shotgun_config_mtime = config_mtime
+                    run(shotgun, args)
+            except SystemExit:
+                response = {'status': 'failed', 'error': 'Invalid arguments'}
+            except Exception as e:
+                print("%s run failed:\n%s" % (NAME, traceback.format_exc()), file=sys.stderr)
+                response = {'status': 'failed', 'error': ''.join(traceback.format_exception_only(type(e), e)).strip(),
+                            'traceback': traceback.format_exc()}
+                shotgun = None
+            handler.connection = None
+            send_line(connection, response)
+        except socket.error:
+            print("%s client disconnected:\n%s" % (NAME, traceback.format_exc()), file=sys.stderr)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            connection.close()
+            busy.clear()
+
 def main():
     #Get current path
-    if len(sys.argv) == 1:
-        scriptFilePath = os.path.dirname(sys.argv[0])
-    else:
-        #Error out - print to stderr - let cron know something went wrong too
-        error_msg = "CnShotgun (cn_shotgun.py) takes no arguments. %s arguments were passed in.\nAborting script." % (len(sys.argv) - 1)
-        print(error_msg, file=sys.stderr)
-        sys.exit(1)
+    scriptFilePath = os.path.dirname(sys.argv[0])
+    #Invalid arguments error out - print to stderr - let cron know something went wrong too
+    args = parse_args()
     try:
-        shotgun = ShotgunPlugin(scriptFilePath)
-        shotgun.start()
+        if args.serve:
+            serve(scriptFilePath)
+        elif args.daemon:
+            ShotgunPlugin(scriptFilePath).run_daemon()
+        else:
+            run(ShotgunPlugin(scriptFilePath), args)
     except Exception as e:
         machine_name = socket.gethostname()
         print("\n--------ERROR---------\n%s failed to complete while being executed on machine: %s\nScript aborted.\nResponse received: %s" % (NAME, machine_name, e.message) , file=sys.stderr)
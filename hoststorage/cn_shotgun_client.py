@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Client of the resident Shotgun plugin worker
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: passes its arguments to the worker started with "cn_shotgun.py --serve" and waits for
+# the run to complete, printing the log records and the error of the run to stderr. When no worker
+# is listening, or when the worker is busy with another run, runs cn_shotgun.py in this process
+# instead, which attaches to the current run or queues the request through the run lock
+# Notes:
+# - Takes the same arguments as cn_shotgun.py, except --daemon and --serve
+# - Only uses the standard library so that it starts fast, do not import the plugin modules here
+
+import json
+import os
+import socket
+import sys
+
+NAME = u'cn_shotgun_client.py'
+# Keep in sync with cn_shotgun.py
+SOCKET_FILE = 'cn_shotgun.sock'
+
+
+def print_stderr(text):
+    # Print text received from the worker, which may not be ASCII
+    stream = getattr(sys.stderr, 'buffer', sys.stderr)
+    stream.write((text + u'\n').encode('utf8'))
+    stream.flush()
+
+
+def read_lines(client):
+    # Lines sent by the worker, until it closes the connection
+    data = b''
+    while True:
+        chunk = client.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        lines = data.split(b'\n')
+        data = lines.pop()
+        for line in lines:
+            yield line
+
+
+def run_plugin(scriptFilePath, args):
+    # Replace this process with cn_shotgun.py
+    script = os.path.join(scriptFilePath, 'cn_shotgun.py')
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+
+def main():
+    scriptFilePath = os.path.dirname(os.path.abspath(sys.argv[0]))
+    working_dir = os.environ.get('PLUGIN_WORKING_DIR') or scriptFilePath
+    # The worker may run from another directory, pass it absolute paths
+    args = [os.path.abspath(arg) if os.path.isfile(arg) else arg for arg in sys.argv[1:]]
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.path.join(working_dir, SOCKET_FILE))
+    except socket.error:
+        run_plugin(scriptFilePath, args)
+    # The worker first tells whether it is busy with another run
+    lines = read_lines(client)
+    try:
+        busy = json.loads(next(lines, b'').decode('utf8')).get('busy', True)
+    except (ValueError, socket.error):
+        busy = True
+    if busy:
+        client.close()
+        run_plugin(scriptFilePath, args)
+    client.sendall((json.dumps({'args': args}) + '\n').encode('utf8'))
+    # The worker sends the log records of the run, then the outcome of the run
+    response = {'status': 'failed', 'error': 'No response from the resident worker'}
+    for line in lines:
+        try:
+            message = json.loads(line.decode('utf8'))
+        except ValueError:
+            continue
+        if 'log' in message:
+            print_stderr(message['log'])
+        elif 'status' in message:
+            response = message
+            break
+    client.close()
+    if response['status'] != 'success':
+        print("\n--------ERROR---------\n%s failed to complete while being executed on machine: %s\nScript aborted.\nResponse received: %s"
+              % (NAME, socket.gethostname(), response.get('error')), file=sys.stderr)
+        if response.get('traceback'):
+            print("\n----FULL TRACEBACK----\n", file=sys.stderr)
+            print_stderr(response['traceback'])
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
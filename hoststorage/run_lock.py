@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Run lock for the Shotgun plugin
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: lets a single process run the plugin at a time, from cron, manual actions, webhooks or
+# the daemon. A run requested while another one is in progress attaches to it when it is the same
+# request, otherwise it is recorded as pending and run by the process holding the lock, merged with
+# the other pending requests, before the lock is released
+# Notes:
+# - The lock file holds the pid, host, start time and request of the run, in PLUGIN_WORKING_DIR
+# - A lock is stale when its process is gone, or when it was not refreshed for staleLockTimeout
+#   seconds, in case of a run on another host. The holder refreshes it while running
+# - Lock and pending request changes are serialized with flock on a guard file, which the system
+#   releases if a process dies. The plugin state updates go through the same guard
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+
+LOCK_FILE = 'cn_shotgun.lock'
+PENDING_FILE = 'cn_shotgun_pending.json'
+GUARD_FILE = 'cn_shotgun.lock.guard'
+# Seconds between two checks of the lock by a run attached to the current one
+WAIT_INTERVAL = 1
+
+
+def merge_requests(pending, request):
+    # Merge two run requests: {"sweep": true} or {"shot_ids": [...], "version_ids": [...], "paths": [...]},
+    # optionally with "rebuild_cache": true. A sweep covers every other request
+    if pending is None:
+        return request
+    merged = {}
+    if pending.get('rebuild_cache') or request.get('rebuild_cache'):
+        merged['rebuild_cache'] = True
+    if pending.get('sweep') or request.get('sweep'):
+        merged['sweep'] = True
+        return merged
+    for key in ('shot_ids', 'version_ids', 'paths'):
+        values = sorted(set(pending.get(key, [])) | set(request.get(key, [])))
+        if values:
+            merged[key] = values
+    return merged
+
+
+class RunLock:
+    def __init__(self, working_dir, stale_after):
+        self.path = os.path.join(working_dir, LOCK_FILE)
+        self.pending_path = os.path.join(working_dir, PENDING_FILE)
+        self.guard_path = os.path.join(working_dir, GUARD_FILE)
+        self.stale_after = stale_after
+        # Content of the lock file of the current run, when the lock is held by another process
+        self.holder = None
+        # Content of the stale lock file replaced when the lock was taken
+        self.stale_holder = None
+        self.heartbeat = None
+
+    @contextlib.contextmanager
+    def guard(self):
+        # Serialize the changes to the files shared by the plugin processes in the working directory
+        with open(self.guard_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, path, content):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(content, f)
+        os.rename(path + '.tmp', path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _is_stale(self, holder):
+        if holder.get('host') == socket.gethostname():
+            try:
+                os.kill(holder['pid'], 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    return True
+        try:
+            return time.time() - os.path.getmtime(self.path) > self.stale_after
+        except OSError:
+            return True
+
+    def _write_lock(self, request):
+        self._write(self.path, {'pid': os.getpid(), 'host': socket.gethostname(), 'started': time.time(), 'request': request})
+
+    def acquire(self, request):
+        # Take the lock for a run of request
+        # Returns "acquired", "attached" when the same request is already running, or "queued"
+        # when the request was recorded as pending for the process holding the lock
+        with self.guard():
+            holder = self._read(self.path)
+            if holder is not None and self._is_stale(holder):
+                self.stale_holder = holder
+                holder = None
+            if holder is None:
+                self._write_lock(request)
+                self._start_heartbeat()
+                return 'acquired'
+            self.holder = holder
+            if holder.get('request') == request:
+                return 'attached'
+            self._write(self.pending_path, merge_requests(self._read(self.pending_path), request))
+            return 'queued'
+
+    def wait(self):
+        # Wait for the run holding the lock to complete, or its lock to turn stale
+        while True:
+            with self.guard():
+                holder = self._read(self.path)
+                if holder is None or holder.get('started') != self.holder.get('started') or self._is_stale(holder):
+                    return
+            time.sleep(WAIT_INTERVAL)
+
+    def take_pending(self):
+        # Get the requests left pending while the lock was held, merged in a single request
+        # The lock is released when there is none, so that no request is left pending
+        with self.guard():
+            request = self._read(self.pending_path)
+            if request is None:
+                self._release()
+                return None
+            self._remove(self.pending_path)
+            self._write_lock(request)
+            return request
+
+    def release(self):
+        # Release the lock, leaving the pending requests to the next run
+        with self.guard():
+            self._release()
+
+    def _release(self):
+        if self.heartbeat is None:
+            return
+        self.heartbeat.set()
+        self.heartbeat = None
+        holder = self._read(self.path)
+        if holder is not None and holder.get('pid') == os.getpid() and holder.get('host') == socket.gethostname():
+            self._remove(self.path)
+
+    def _start_heartbeat(self):
+        # Refresh the lock file while the lock is held, so that it does not turn stale
+        stop = self.heartbeat = threading.Event()
+
+        def refresh():
+            while not stop.wait(max(1, self.stale_after / 4.0)):
+                try:
+                    os.utime(self.path, None)
+                except OSError:
+                    pass
+
+        thread = threading.Thread(target=refresh, name='cn-shotgun-lock')
+        thread.daemon = True
+        thread.start()
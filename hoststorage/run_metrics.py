@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Run metrics for the Shotgun plugin
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: records the duration of each phase of a plugin run, the calls made to the
+# ClarityNow and Shotgun APIs and item counts, and writes them to PLUGIN_WORKING_DIR
+# as a JSON run summary and a Prometheus textfile
+# Notes:
+# - Shared by cn_shotgun.py (Python 2.7) and app.py (Python 3), keep it compatible with both
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+SUMMARY_FILE = 'cn_shotgun_metrics.json'
+PROMETHEUS_FILE = 'cn_shotgun.prom'
+METRIC_PREFIX = 'cn_shotgun'
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        # Start recording a new run
+        with self.lock:
+            self.started = time.time()
+            self.finished = None
+            self.status = 'running'
+            self.mode = None
+            self.phases = {}
+            self.calls = {}
+            self.counts = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Time a phase of the run
+        # Phases can be nested, the time spent in a nested phase is only counted for the nested phase
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        started = time.time()
+        stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+
+    def timed(self, iterable, name):
+        # Iterate over iterable, counting the time spent producing each item in the name phase
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record_call(self, backend, method, elapsed, failed=False):
+        with self.lock:
+            call = self.calls.setdefault((backend, method), [0, 0.0, 0])
+            call[0] += 1
+            call[1] += elapsed
+            if failed:
+                call[2] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge(self, summary):
+        # Add the phases, calls and counts of the summary of another run, such as a worker process
+        with self.lock:
+            for name, elapsed in summary['phases'].items():
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            for call in summary['calls']:
+                merged = self.calls.setdefault((call['backend'], call['method']), [0, 0.0, 0])
+                merged[0] += call['count']
+                merged[1] += call['seconds']
+                merged[2] += call['errors']
+            for name, value in summary['counts'].items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self, status):
+        with self.lock:
+            self.finished = time.time()
+            self.status = status
+
+    def summary(self):
+        with self.lock:
+            finished = self.finished or time.time()
+            return {
+                'status': self.status,
+                'mode': self.mode,
+                'started': self.started,
+                'finished': self.finished,
+                'duration': finished - self.started,
+                'phases': dict(self.phases),
+                'calls': [dict(backend=backend, method=method, count=call[0], seconds=call[1], errors=call[2])
+                          for (backend, method), call in sorted(self.calls.items())],
+                'counts': dict(self.counts),
+            }
+
+    def prometheus(self, summary=None):
+        # Format the run summary as Prometheus text exposition
+        summary = summary or self.summary()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s gauge' % (METRIC_PREFIX, name))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels)
+                lines.append('%s_%s%s %s' % (METRIC_PREFIX, name, '{%s}' % label_text if label_text else '', repr(float(value))))
+
+        metric('last_run_timestamp_seconds', 'Start time of the last run', [((), summary['started'])])
+        metric('last_run_duration_seconds', 'Duration of the last run', [((), summary['duration'])])
+        metric('last_run_success', 'Whether the last run succeeded', [((), 1 if summary['status'] == 'success' else 0)])
+        metric('phase_seconds', 'Time spent in each phase of the last run',
+               [((('phase', name),), elapsed) for name, elapsed in sorted(summary['phases'].items())])
+        metric('api_calls', 'Calls made to each API method during the last run',
+               [((('backend', call['backend']), ('method', call['method'])), call['count']) for call in summary['calls']])
+        metric('api_call_seconds', 'Time spent calling each API method during the last run',
+               [((('backend', call['backend']), ('method', call['method'])), call['seconds']) for call in summary['calls']])
+        metric('api_call_errors', 'Failed calls to each API method during the last run',
+               [((('backend', call['backend']), ('method', call['method'])), call['errors']) for call in summary['calls']])
+        metric('items', 'Items processed during the last run',
+               [((('item', name),), value) for name, value in sorted(summary['counts'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, working_dir):
+        # Write the JSON run summary and the Prometheus textfile, replacing the previous ones atomically
+        summary = self.summary()
+        for file_name, content in ((SUMMARY_FILE, json.dumps(summary, indent=2, sort_keys=True)),
+                                   (PROMETHEUS_FILE, self.prometheus(summary))):
+            path = os.path.join(working_dir, file_name)
+            with open(path + '.tmp', 'w') as f:
+                f.write(content)
+            os.rename(path + '.tmp', path)
+        return summary
+
+
+class InstrumentedClient:
+    """Proxy to an API client recording the count and latency of each method call"""
+
+    def __init__(self, client, backend, metrics):
+        self._client = client
+        self._backend = backend
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            started = time.time()
+            try:
+                result = attribute(*args, **kwargs)
+            except:
+                self._metrics.record_call(self._backend, name, time.time() - started, failed=True)
+                raise
+            self._metrics.record_call(self._backend, name, time.time() - started)
+            return result
+        return call
+
+
+def load_summary(working_dir):
+    # Read the summary of the latest run, None if there is none
+    try:
+        with open(os.path.join(working_dir, SUMMARY_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Shot cache for the Shotgun plugin
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: keeps the path of each shot tag between runs in a sqlite database of PLUGIN_WORKING_DIR,
+# so that shot folders are not resolved again with a report on every run, the fingerprint of each
+# shot folder and its shotgun versions, so that unchanged shot folders are not listed again, the
+# subfolders of each shot folder, for the version folder discovery by sequence, the version tag committed on each version folder, so that only the tags which change are written, and
+# the shot tags matching no shotgun shot, so that incremental runs do not resolve them again
+# Notes:
+# - Shared by the threads of a run, every access goes through a single lock
+
+import collections
+import json
+import sqlite3
+import threading
+
+CACHE_FILE = 'cn_shotgun_cache.sqlite'
+# Maximum number of names per query, below the sqlite limit of 999 variables
+QUERY_CHUNK_SIZE = 500
+
+# Stands for the path info of a report result, only the path is cached
+CachedPath = collections.namedtuple('CachedPath', ['path'])
+
+
+class ShotCache:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS shot_paths '
+                            '(name TEXT PRIMARY KEY, tag_id INTEGER NOT NULL, path TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS shot_fingerprints '
+                            '(name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS shot_subfolders '
+                            '(path TEXT PRIMARY KEY, attributes TEXT NOT NULL, names TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS folder_tags '
+                            '(path TEXT PRIMARY KEY, tag TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS shot_tag_misses '
+                            '(rule TEXT NOT NULL, name TEXT NOT NULL, tag_id INTEGER NOT NULL, PRIMARY KEY (rule, name))')
+            self.db.commit()
+
+    def _select(self, query, names):
+        # Run a query with a "name IN (...)" clause over chunks of names
+        rows = []
+        with self.lock:
+            for i in range(0, len(names), QUERY_CHUNK_SIZE):
+                chunk = names[i:i + QUERY_CHUNK_SIZE]
+                rows.extend(self.db.execute(query % ','.join('?' * len(chunk)), chunk))
+        return rows
+
+    def get_paths(self, shot_tags):
+        # Get the cached paths of the shot tags, as a shot tag name to CachedPath map
+        # A path cached for another tag id of the same name is stale and left out
+        ids = dict((shot_tag.name, shot_tag.id) for shot_tag in shot_tags)
+        paths = {}
+        for name, tag_id, path in self._select('SELECT name, tag_id, path FROM shot_paths WHERE name IN (%s)', list(ids)):
+            if ids[name] == tag_id:
+                paths[name] = CachedPath(path)
+        return paths
+
+    def set_paths(self, entries):
+        # Cache (shot tag name, tag id, path) entries, replacing the previous path of each name
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO shot_paths (name, tag_id, path) VALUES (?, ?, ?)', entries)
+            self.db.commit()
+
+    def delete_path(self, name):
+        with self.lock:
+            self.db.execute('DELETE FROM shot_paths WHERE name = ?', (name,))
+            self.db.commit()
+
+    def get_fingerprints(self, names):
+        # Get the fingerprints recorded for the shot tag names, as a name to fingerprint map
+        return dict(self._select('SELECT name, fingerprint FROM shot_fingerprints WHERE name IN (%s)', list(names)))
+
+    def set_fingerprints(self, entries):
+        # Record (shot tag name, fingerprint) entries
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO shot_fingerprints (name, fingerprint) VALUES (?, ?)', entries)
+            self.db.commit()
+
+    def get_subfolders(self, paths):
+        # Get the subfolders recorded for the shot folders, as a path to (attributes, subfolder names) map
+        return dict((path, (attributes, json.loads(names)))
+                    for path, attributes, names in self._select('SELECT path, attributes, names FROM shot_subfolders WHERE path IN (%s)', list(paths)))
+
+    def set_subfolders(self, entries):
+        # Record (shot folder path, attributes, subfolder names) entries
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO shot_subfolders (path, attributes, names) VALUES (?, ?, ?)',
+                                [(path, attributes, json.dumps(names)) for path, attributes, names in entries])
+            self.db.commit()
+
+    def get_folder_tags(self, paths):
+        # Get the version tags last committed on the folders, as a path to tag map, "" for a cleared folder
+        return dict(self._select('SELECT path, tag FROM folder_tags WHERE path IN (%s)', list(paths)))
+
+    def set_folder_tags(self, entries):
+        # Record (folder path, tag or "") entries
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO folder_tags (path, tag) VALUES (?, ?)', entries)
+            self.db.commit()
+
+    def get_shot_tag_misses(self, rule):
+        # Get the shot tags which did not follow the shot tag rule, or matched no shotgun shot, as a
+        # shot tag name to tag id map. rule is the key of the shot tag rule they were resolved with
+        with self.lock:
+            return dict(self.db.execute('SELECT name, tag_id FROM shot_tag_misses WHERE rule = ?', (rule,)))
+
+    def add_shot_tag_misses(self, rule, entries):
+        # Record (shot tag name, tag id) entries of shot tags resolved with rule
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO shot_tag_misses (rule, name, tag_id) VALUES (?, ?, ?)',
+                                [(rule, name, tag_id) for name, tag_id in entries])
+            self.db.commit()
+
+    def delete_shot_tag_misses(self, rule, names):
+        # Forget the shot tags of rule which matched a shotgun shot since
+        with self.lock:
+            self.db.executemany('DELETE FROM shot_tag_misses WHERE rule = ? AND name = ?', [(rule, name) for name in names])
+            self.db.commit()
+
+    def clear_shot_tag_misses(self):
+        with self.lock:
+            self.db.execute('DELETE FROM shot_tag_misses')
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM shot_paths')
+            self.db.execute('DELETE FROM shot_fingerprints')
+            self.db.execute('DELETE FROM shot_subfolders')
+            self.db.execute('DELETE FROM folder_tags')
+            self.db.execute('DELETE FROM shot_tag_misses')
+            self.db.commit()
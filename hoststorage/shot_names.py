@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Shot tag naming rule for the Shotgun plugin
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: maps the shot tag names to the (project name, sequence name, shot code) keys of the
+# shotgun shots, and back. Names are parsed with the template of the autotag apply_tag rule,
+# "$1_$2_$3" by default, or with a regular expression
+# Notes:
+# - With a template, a name whose parts contain the delimiters splits in several ways, every
+#   candidate key is returned and the first one found in Shotgun wins
+# - Parsed names are cached, names not following the rule as well, so that they are only parsed
+#   once per process. The shot tags not following the rule, or matching no shot, are also kept in
+#   the shot cache under the key of the rule, see ShotCache.get_shot_tag_misses
+
+import re
+
+# Key parts, in the order of the $1, $2 and $3 placeholders of the autotag rule
+KEY_PARTS = ('project', 'sequence', 'shot')
+PLACEHOLDER = re.compile(r'\$([123])')
+# Parsed names kept in the cache before it is cleared
+MAX_CACHED_NAMES = 1000000
+
+
+class ShotNameRule:
+    def __init__(self, template='$1_$2_$3', pattern=None):
+        # template: tag name of the autotag apply_tag rule, with or without the "shot/" category
+        # pattern: optional regular expression parsing the tag names instead of the template, with
+        # project, sequence and shot named groups, or three groups in that order
+        if '/' in template:
+            template = template.split('/', 1)[1]
+        # Identifies the rule, for the results persisted between runs
+        self.key = '%s %s' % (template, pattern or '')
+        placeholders = PLACEHOLDER.findall(template)
+        if sorted(placeholders) != ['1', '2', '3']:
+            raise ValueError('Shot tag template must hold $1, $2 and $3 once: %s' % template)
+        # Literal text around the placeholders, and the key part of each placeholder
+        self.literals = PLACEHOLDER.split(template)[::2]
+        self.order = [int(placeholder) - 1 for placeholder in placeholders]
+        if not all(self.literals[1:-1]):
+            raise ValueError('Shot tag template placeholders must be separated: %s' % template)
+        self.pattern = None
+        if pattern:
+            self.pattern = re.compile('(?:%s)\\Z' % pattern)
+            if set(KEY_PARTS) <= set(self.pattern.groupindex):
+                self.groups = KEY_PARTS
+            elif self.pattern.groups == 3:
+                self.groups = (1, 2, 3)
+            else:
+                raise ValueError('Shot tag pattern needs project, sequence and shot groups: %s' % pattern)
+        # The common "$1_$2_$3" like templates split with str.split
+        self.delimiter = None
+        if self.order == [0, 1, 2] and not self.literals[0] and not self.literals[3] and self.literals[1] == self.literals[2]:
+            self.delimiter = self.literals[1]
+        self.cache = {}
+
+    def parse(self, name):
+        # Candidate keys of a shot tag name, empty if the name does not follow the rule
+        keys = self.cache.get(name)
+        if keys is None:
+            if len(self.cache) >= MAX_CACHED_NAMES:
+                self.cache.clear()
+            keys = self.cache[name] = self._parse(name)
+        return keys
+
+    def _parse(self, name):
+        if self.pattern is not None:
+            match = self.pattern.match(name)
+            if match is None:
+                return ()
+            key = tuple(match.group(group) for group in self.groups)
+            return (key,) if all(key) else ()
+        if self.delimiter is not None:
+            parts = name.split(self.delimiter)
+            if len(parts) == 3:
+                return (tuple(parts),) if all(parts) else ()
+            # Parts holding the delimiter themselves
+            delimiter = self.delimiter
+            keys = ((delimiter.join(parts[:i]), delimiter.join(parts[i:j]), delimiter.join(parts[j:]))
+                    for i in range(1, len(parts) - 1) for j in range(i + 1, len(parts)))
+            return tuple(key for key in keys if all(key))
+        return self._parse_template(name)
+
+    def _parse_template(self, name):
+        # Every split of the name between the literals of the template, with non-empty parts
+        first, second, third, last = self.literals
+        if not name.startswith(first) or not name.endswith(last) or len(name) < len(first) + len(last):
+            return ()
+        body = name[len(first):len(name) - len(last)]
+        keys = []
+        i = body.find(second, 1)
+        while i != -1:
+            j = body.find(third, i + len(second) + 1)
+            while j != -1:
+                values = (body[:i], body[i + len(second):j], body[j + len(third):])
+                if values[2]:
+                    key = [None] * 3
+                    for part, value in zip(self.order, values):
+                        key[part] = value
+                    keys.append(tuple(key))
+                j = body.find(third, j + 1)
+            i = body.find(second, i + 1)
+        return tuple(keys)
+
+    def format(self, key):
+        # Shot tag name of a (project name, sequence name, shot code) key
+        return self.prefix(key)
+
+    def prefix(self, names):
+        # Start of the shot tag names of the shots of a project, (project), of a sequence,
+        # (project, sequence), or of a shot, (project, sequence, shot code)
+        # The first placeholders of the template must be the project and the sequence, else and with
+        # a pattern, every name may belong to the project or sequence and the prefix is empty
+        if len(names) < 3 and (self.pattern is not None or self.order[:len(names)] != list(range(len(names)))):
+            return ''
+        text = self.literals[0]
+        for i, part in enumerate(self.order[:len(names)]):
+            text += names[part] + self.literals[i + 1]
+        return text
+
+    def project(self, name):
+        # Project name of the first candidate key of a shot tag name, the name itself if it has none
+        keys = self.parse(name)
+        return keys[0][0] if keys else name
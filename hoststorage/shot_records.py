@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+from __future__ import print_function # Use Python 3 printing
+# Compact shot records for the Shotgun plugin
+# Copyright (C) 2020 Dell Inc. or its subsidiaries
+# Summary: keeps only the fields of the shotgun shots used by the plugin, in slotted records
+# sharing the strings repeated over many shots (project, sequence and status names)
+# Notes:
+# - Python 2 intern() does not take unicode strings, the records share strings through a dict
+
+
+class ShotRecord(object):
+    __slots__ = ('id', 'project', 'sequence', 'code', 'status', 'versions')
+
+    def __init__(self, id, project, sequence, code, status, versions):
+        self.id = id
+        self.project = project
+        self.sequence = sequence
+        self.code = code
+        self.status = status
+        # Names of the shotgun versions of the shot
+        self.versions = versions
+
+    def key(self):
+        # Key identifying a shotgun shot: (project name, sequence name, shot code)
+        return (self.project, self.sequence, self.code)
+
+
+class ShotRecordFactory:
+    def __init__(self):
+        self.strings = {}
+
+    def share(self, value):
+        # Get the shared copy of a string
+        return self.strings.setdefault(value, value)
+
+    def create(self, shot):
+        # Make a record from a shot returned by the shotgun API
+        # Returns None for shots without a project or a sequence, they cannot be matched against a shot tag
+        if not shot.get('project') or not shot.get('sg_sequence'):
+            return None
+        return ShotRecord(shot['id'],
+                          self.share(shot['project']['name']),
+                          self.share(shot['sg_sequence']['name']),
+                          shot['code'],
+                          self.share(shot.get('sg_status_list')),
+                          tuple(version['name'] for version in shot.get('sg_versions') or ()))
@@ -37,6 +37,10 @@ export PLUGIN_DEFAULT_YAML=/hoststorage/ca.control
 # were a root user with the given username. USE WITH CAUTION.
 #export AUTH_OVERRIDE=root_override
 
+# Uncomment the following line to receive the Shotgun webhook deliveries of Shot
+# and Version events on /webhooks/shotgun/, with the secret set on the webhook.
+#export SHOTGUN_WEBHOOK_SECRET=your_webhook_secret
+
 # Set plugin to DataIQ
 export SHOTGUN_PLUGIN_MODE=dataiq
 
@@ -46,6 +50,14 @@ python3.8 -m pip install /plugin/dataiq-plugin /plugin/plugin-legacy --no-index
 
 pip install /hoststorage/deps2/* --no-index
 
+# Uncomment the following line to keep the shots updated from the Shotgun
+# event log, in addition to the scheduled runs.
+#python2.7 /hoststorage/cn_shotgun.py --daemon &
+
+# Keep a resident plugin worker with warm connections, the actions and cron jobs
+# run through cn_shotgun_client.py and fall back to a new process without it.
+python2.7 /hoststorage/cn_shotgun.py --serve &
+
 # Begin executing the flask server.
 cd /hoststorage/
 export FLASK_APP=/hoststorage/app.py
@@ -0,0 +1,166 @@
+"""
+Shotgun webhook receiver
+
+Receives the Shotgun webhook deliveries of Shot and Version events and updates the
+affected shots only, by running cn_shotgun.py with --shot-ids and --version-ids.
+
+Deliveries are authenticated with the X-SG-SIGNATURE header, the HMAC-SHA1 of the
+request body keyed with the webhook secret configured on Shotgun. The ids of the
+received entities are deduplicated in a bounded in-memory queue and coalesced over
+a short window, so that a burst of changes on the same shots results in a single run.
+When the queue is full, the pending ids are dropped and a full sweep is run instead.
+
+Recorded deliveries can be replayed with any HTTP client, for instance:
+
+    curl -X POST -H "X-SG-SIGNATURE: sha1=$(openssl dgst -sha1 -hmac "$SECRET" -r payload.json | cut -d' ' -f1)" \
+        --data-binary @payload.json http://localhost:5000/webhooks/shotgun/
+"""
+import hashlib
+import hmac
+import json
+import logging
+import subprocess
+import threading
+import time
+
+from flask import Blueprint, jsonify, request
+
+log = logging.getLogger('app.webhooks')
+
+SIGNATURE_HEADER = 'X-SG-SIGNATURE'
+ENTITY_TYPES = ('Shot', 'Version')
+
+
+def verify_signature(secret, body, signature):
+    # Shotgun signs the body with HMAC-SHA1, the header value is "sha1=<hex digest>"
+    if not secret or not signature:
+        return False
+    expected = 'sha1=' + hmac.new(secret.encode('utf8'), body, hashlib.sha1).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def get_entities(payload):
+    # Get the (type, id) of the Shot and Version entities of a webhook payload
+    # Batched deliveries hold a list of deliveries, each formatted as a single delivery
+    data = payload.get('data')
+    if not isinstance(data, dict):
+        return []
+    deliveries = data.get('deliveries') if isinstance(data.get('deliveries'), list) else [data]
+    entities = []
+    for delivery in deliveries:
+        if isinstance(delivery, dict) and isinstance(delivery.get('data'), dict):
+            delivery = delivery['data']
+        entity = delivery.get('entity') if isinstance(delivery, dict) else None
+        if isinstance(entity, dict) and entity.get('type') in ENTITY_TYPES and isinstance(entity.get('id'), int):
+            entities.append((entity['type'], entity['id']))
+    return entities
+
+
+class UpdateQueue:
+    """
+    Bounded queue of the shot and version ids to update, drained by a worker thread
+
+    Ids already pending are not queued twice. Once an id is queued, the worker waits
+    batch_window seconds for more ids, then runs command with all the pending ids.
+    """
+
+    def __init__(self, command, max_size=10000, batch_window=5.0):
+        self.command = list(command)
+        self.max_size = max_size
+        self.batch_window = batch_window
+        self.condition = threading.Condition()
+        self.shot_ids = set()
+        self.version_ids = set()
+        self.overflowed = False
+        self.worker = None
+
+    def put(self, entity_type, entity_id):
+        # Queue an entity, returns whether it was not pending yet
+        with self.condition:
+            ids = self.shot_ids if entity_type == 'Shot' else self.version_ids
+            if self.overflowed or entity_id in ids:
+                return False
+            if len(self.shot_ids) + len(self.version_ids) >= self.max_size:
+                # Too many changes to track them one by one, sweep everything instead
+                log.warning('Webhook queue full, falling back to a full sweep')
+                self.shot_ids.clear()
+                self.version_ids.clear()
+                self.overflowed = True
+            else:
+                ids.add(entity_id)
+            self.condition.notify()
+            return True
+
+    def pending(self):
+        with self.condition:
+            return len(self.shot_ids) + len(self.version_ids)
+
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._work, name='shotgun-webhooks')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _take(self):
+        # Wait for pending ids, let them coalesce, then take them all
+        with self.condition:
+            while not (self.shot_ids or self.version_ids or self.overflowed):
+                self.condition.wait()
+        time.sleep(self.batch_window)
+        with self.condition:
+            batch = (sorted(self.shot_ids), sorted(self.version_ids), self.overflowed)
+            self.shot_ids = set()
+            self.version_ids = set()
+            self.overflowed = False
+            return batch
+
+    def _arguments(self, shot_ids, version_ids, overflowed):
+        if overflowed:
+            return self.command
+        arguments = list(self.command)
+        if shot_ids:
+            arguments += ['--shot-ids', ','.join(str(i) for i in shot_ids)]
+        if version_ids:
+            arguments += ['--version-ids', ','.join(str(i) for i in version_ids)]
+        return arguments
+
+    def _work(self):
+        while True:
+            shot_ids, version_ids, overflowed = self._take()
+            log.info('Updating %d shots and %d versions from webhooks%s'
+                     % (len(shot_ids), len(version_ids), ', full sweep' if overflowed else ''))
+            try:
+                subprocess.check_call(self._arguments(shot_ids, version_ids, overflowed))
+            except (OSError, subprocess.CalledProcessError):
+                log.exception('Failed to update the shots from webhooks')
+
+
+def create_blueprint(get_secret, queue):
+    """
+    Blueprint of the webhook endpoint, queueing the received entities in queue
+
+    get_secret is called for each delivery, so that a changed secret is used without
+    restarting the app.
+    """
+    blueprint = Blueprint('shotgun_webhooks', __name__)
+
+    @blueprint.route('/webhooks/shotgun/', methods=['POST'])
+    def shotgun_webhook():
+        secret = get_secret()
+        if not secret:
+            return jsonify(error='Shotgun webhooks are not configured'), 503
+        body = request.get_data()
+        if not verify_signature(secret, body, request.headers.get(SIGNATURE_HEADER)):
+            return jsonify(error='Invalid signature'), 401
+        try:
+            payload = json.loads(body.decode('utf8'))
+        except ValueError:
+            return jsonify(error='Invalid JSON payload'), 400
+        if not isinstance(payload, dict):
+            return jsonify(error='Invalid JSON payload'), 400
+        entities = get_entities(payload)
+        queued = sum(1 for entity_type, entity_id in entities if queue.put(entity_type, entity_id))
+        queue.start()
+        return jsonify(received=len(entities), queued=queued, pending=queue.pending()), 202
+
+    return blueprint